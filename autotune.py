@@ -0,0 +1,225 @@
+#!/usr/bin/env python2
+import argparse
+from binascii import hexlify
+import imp
+import json
+import multiprocessing
+import os
+import platform
+from StringIO import StringIO
+import struct
+import tempfile
+import time
+
+from bench import (
+    PARAMS,
+    peak_rss_mb,
+    run_isolated,
+    solve_all,
+)
+from convert import get_minimal_from_indices
+from pow import (
+    PIPELINE_DEPTH,
+    POOL_SOLVERS,
+    SLOW_SOLVERS,
+    SOLVERS,
+    equihash_params,
+    get_solver,
+    pack_nonce,
+    pipelined_tables,
+    start_pool,
+)
+
+# Where the fastest configurations found are kept
+DEFAULT_PROFILE = os.path.join(os.path.expanduser('~'), '.zcash-pow-profile.json')
+
+# The header I the probe solves are for
+PROBE_HEADER = b'Equihash autotune probe'.ljust(108, b'\0')
+
+# Number of headers verified by each verifier probe
+VERIFY_PROBE_HEADERS = 512
+
+
+def host_id():
+    '''Identifies this host by its name, number of CPUs and amount of RAM, so
+    that a profile is not used on a host that has been resized.'''
+    ram_mb = os.sysconf('SC_PHYS_PAGES')*os.sysconf('SC_PAGE_SIZE') >> 20
+    return '%s/%d cpus/%d MB' % (platform.node(), multiprocessing.cpu_count(), ram_mb)
+
+def load_profile(path=None):
+    '''Returns the contents of the profile at path, or an empty profile if it
+    is missing or corrupt.'''
+    try:
+        with open(path or DEFAULT_PROFILE) as f:
+            profile = json.load(f)
+    except (IOError, ValueError):
+        return {}
+    return profile if isinstance(profile, dict) else {}
+
+def save_profile(profile, path=None):
+    '''Replaces the profile at path atomically.'''
+    path = path or DEFAULT_PROFILE
+    fd, tmp = tempfile.mkstemp(prefix='.', dir=os.path.dirname(path) or '.')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+def load_tuned(n, k, path=None):
+    '''Returns the configuration found fastest for (n, k) on this host, or
+    None if it has not been tuned.'''
+    return load_profile(path).get(host_id(), {}).get('%d,%d' % (n, k))
+
+def candidates(solvers, cpus):
+    '''Returns the configurations to probe for each of solvers, with one
+    worker, half and all of the CPUs, and pipelined with one worker. Solvers
+    that run their own workers only get one miner worker.'''
+    workers = sorted(set([1, max(cpus/2, 1), cpus]))
+    configs = []
+    for name in solvers:
+        configs += [{'solver': name, 'workers': w, 'pipeline': None} for w in workers
+                    if w == 1 or name not in POOL_SOLVERS]
+        configs.append({'solver': name, 'workers': 1, 'pipeline': PIPELINE_DEPTH})
+    return configs
+
+def probe_worker(args):
+    '''Solves the probe header for count of the nonces start, start+stride,
+    ... with the named solver, and returns a list of (nonce, solutions).'''
+    name, n, k, start, stride, count, pipeline = args
+    digest = equihash_params(n, k).header_digest(PROBE_HEADER)
+    tables = pipelined_tables(digest, n, k, start, stride, pipeline) if pipeline else None
+    nonces = range(start, start + count*stride, stride)
+    try:
+        solns = solve_all(get_solver(name), n, k, [(PROBE_HEADER, nonce) for nonce in nonces],
+                          tables=tables)
+    finally:
+        if tables: tables.close()
+    return zip(nonces, solns)
+
+def probe_config(config, n, k, probes, conn):
+    '''Times probes solves per worker with config, the way the miner runs it,
+    and sends the timings and solutions found through conn. Runs in its own
+    process, as the benchmarks do.'''
+    workers = config['workers']
+    args = [(config['solver'], n, k, w, workers, probes, config['pipeline'])
+            for w in range(workers)]
+    start = time.time()
+    if workers == 1:
+        results = [probe_worker(args[0])]
+    else:
+        pool = start_pool(workers)
+        try:
+            results = pool.map(probe_worker, args)
+        finally:
+            pool.terminate()
+    seconds = time.time() - start
+    conn.send({
+        'solves_per_sec': workers*probes / seconds,
+        'peak_rss_mb': peak_rss_mb(),
+        'solutions': dict(s for r in results for s in r),
+    })
+
+def probe_header(n, k, nonce, soln):
+    '''Returns a block header for PROBE_HEADER with the given nonce and
+    solution, in hexadecimal.'''
+    minimal = bytes(get_minimal_from_indices(soln, n/(k+1) + 1))
+    size = len(minimal)
+    size = chr(size) if size < 253 else b'\xfd' + struct.pack('<H', size)
+    return hexlify(PROBE_HEADER + pack_nonce(nonce) + size + minimal)
+
+def probe_verifier(n, k, solutions, workers):
+    '''Times verifying headers for the (nonce, solutions) found by the
+    probes with print-soln.py, and returns the headers verified per
+    second.'''
+    print_soln = imp.load_source(
+        'print_soln', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'print-soln.py'))
+    headers = [probe_header(n, k, nonce, soln)
+               for nonce, solns in sorted(solutions.items()) for soln in solns]
+    headers = (headers * (VERIFY_PROBE_HEADERS/len(headers) + 1))[:VERIFY_PROBE_HEADERS]
+    start = time.time()
+    count, failures = print_soln.batch_verify(n, k, StringIO('\n'.join(headers)),
+                                              StringIO(), workers=workers)
+    seconds = time.time() - start
+    if failures:
+        raise RuntimeError('The probe solutions failed to verify')
+    return count / seconds
+
+def tune(n, k, solvers, probes):
+    '''Probes each candidate configuration for (n, k), and returns the
+    fastest one, along with the number of processes to verify with.'''
+    cpus = multiprocessing.cpu_count()
+    best = None
+    # The solutions found for each nonce by the first configuration to solve it
+    reference = {}
+    for config in candidates(solvers, cpus):
+        r = run_isolated(probe_config, (config, n, k, probes))
+        label = '%-8s %3d,%-2d %2d workers %-11s' % (
+            config['solver'], n, k, config['workers'],
+            'pipeline %d' % config['pipeline'] if config['pipeline'] else '')
+        if r is None:
+            print '%s failed' % label
+            continue
+        correct = all(reference.setdefault(nonce, solns) == solns
+                      for nonce, solns in r['solutions'].items())
+        print '%s %s %7.3f solves/s %8.1f MB' % (
+            label, 'ok  ' if correct else 'FAIL', r['solves_per_sec'], r['peak_rss_mb'])
+        if correct and (best is None or r['solves_per_sec'] > best['solves_per_sec']):
+            best = dict(config, solves_per_sec=r['solves_per_sec'],
+                        peak_rss_mb=r['peak_rss_mb'])
+    if best is None:
+        return None
+
+    if any(reference.values()):
+        rates = dict((w, probe_verifier(n, k, reference, w))
+                     for w in sorted(set([1, cpus])))
+        for w, rate in sorted(rates.items()):
+            print 'verify   %3d,%-2d %2d workers %7.1f headers/s' % (n, k, w, rate)
+        best['verify_workers'] = max(rates, key=rates.get)
+    return best
+
+def autotune(params, solvers, probes, slow=False, path=None):
+    '''Tunes each (n, k) and records the fastest configurations for this host
+    in the profile at path.'''
+    results = {}
+    for n, k in params:
+        names = [s for s in solvers if slow or s not in SLOW_SOLVERS or (n, k) == PARAMS[0]]
+        best = tune(n, k, names, probes)
+        if best:
+            results['%d,%d' % (n, k)] = best
+    # Reload, so that tuning for other hosts or parameters meanwhile is kept
+    profile = load_profile(path)
+    profile.setdefault(host_id(), {}).update(results)
+    save_profile(profile, path)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Find the fastest way to mine on this host, and save it for pow.py')
+    parser.add_argument('-s', '--solver', action='append', choices=SOLVERS,
+                        help='a solver to try (default: all that are available)')
+    parser.add_argument('-p', '--params', action='append',
+                        help='an n,k parameter set to tune (default: %s)' %
+                        ' '.join('%d,%d' % p for p in PARAMS))
+    parser.add_argument('--probes', type=int, default=1,
+                        help='number of nonces each worker solves per configuration')
+    parser.add_argument('--slow', action='store_true',
+                        help='also try the pure-Python solvers on large parameters')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='the profile to record the results in (default: %s)' %
+                        DEFAULT_PROFILE)
+    args = parser.parse_args()
+
+    solvers = args.solver
+    if not solvers:
+        # The NumPy solvers are optional
+        try:
+            import pow_numpy
+            solvers = SOLVERS
+        except ImportError:
+            solvers = [s for s in SOLVERS if s in SLOW_SOLVERS]
+    params = [tuple(int(x) for x in p.split(',')) for p in args.params] if args.params else PARAMS
+    for p, best in sorted(autotune(params, solvers, args.probes, args.slow,
+                                   args.profile).items()):
+        print 'Fastest for %s: %s with %d workers%s' % (
+            p, best['solver'], best['workers'],
+            ', pipelined' if best['pipeline'] else '')
@@ -0,0 +1,14 @@
+#!/usr/bin/env python2
+import hashlib
+
+# The scripts run on Python 2, whose hashlib has no BLAKE2b
+from pyblake2 import blake2b
+BLAKE2B_BACKEND = 'pyblake2'
+
+# hashlib's SHA-256 is always available, and much cheaper to import and call
+# than the cryptography module's
+SHA256_BACKEND = 'hashlib'
+sha256 = hashlib.sha256
+
+def backend_name():
+    return 'blake2b: %s, sha256: %s' % (BLAKE2B_BACKEND, SHA256_BACKEND)
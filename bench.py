@@ -0,0 +1,189 @@
+#!/usr/bin/env python2
+import argparse
+import imp
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import time
+
+from pow import (
+    SLOW_SOLVERS,
+    SOLVERS,
+    equihash_params,
+    get_solver,
+    start_process,
+)
+
+PARAMS = [(96, 5), (200, 9), (144, 5)]
+
+
+def zcash_test_vectors():
+    '''Returns the (n, k, I, nonce, solns) test vectors of test-pow.py.'''
+    return imp.load_source(
+        'test_pow', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test-pow.py')
+    ).ZCASH_TEST_VECTORS
+
+def solve_all(solver, n, k, inputs, hook=None, tables=None):
+    '''Solves H(I||V||...) for each (I, V) of inputs with solver, and returns
+    the sorted solutions of each. If given, tables yields (nonce, first list)
+    for each input, as pipelined_tables does.'''
+    ret = []
+    for I, nonce in inputs:
+        digest = equihash_params(n, k).nonce_digest(I, nonce)
+        solver_args = {'table': next(tables)[1]} if tables else {}
+        ret.append(sorted(solver(digest, n, k, hook=hook, **solver_args)))
+    return ret
+
+def peak_rss_mb():
+    '''Returns the peak memory use of this process or its children, in MB.'''
+    # ru_maxrss is in kilobytes on Linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.0
+
+def run_isolated(target, args):
+    '''Runs target(*args, conn) in its own process, so that its peak memory
+    use is measured separately, and returns what it sends through conn, or
+    None if it fails.'''
+    parent, child = multiprocessing.Pipe()
+    p = start_process(target, args + (child,), daemon=False)
+    child.close()
+    try:
+        return parent.recv()
+    except EOFError:
+        return None
+    finally:
+        p.join()
+
+def bench_solver(name, n, k, vectors, ram_budget, tmp_dir, conn):
+    '''Solves each (I, nonce, solns) test vector with the named solver, and
+    sends the timings through conn, along with the phase records of the
+    last solve. ram_budget and tmp_dir are passed to the disk solver.'''
+    if name == 'disk':
+        solver = get_solver(name, ram_budget=ram_budget, tmp_dir=tmp_dir)
+    else:
+        solver = get_solver(name)
+    phases = {}
+    records = []
+    def hook(record):
+        phases[record['phase']] = phases.get(record['phase'], 0) + record['seconds']
+        # Keep the records of the last solve, which start with its list
+        if record['phase'] == 'list':
+            del records[:]
+        records.append(record)
+
+    start = time.time()
+    rets = solve_all(solver, n, k, [tv[:2] for tv in vectors], hook)
+    seconds = time.time() - start
+    solutions = sum(len(ret) for ret in rets)
+    conn.send({
+        'solver': name,
+        'n': n,
+        'k': k,
+        'solves': len(vectors),
+        'seconds': seconds,
+        'solves_per_sec': len(vectors) / seconds,
+        'solutions_per_sec': solutions / seconds,
+        'peak_rss_mb': peak_rss_mb(),
+        'phases': dict((p, t / len(vectors)) for p, t in phases.items()),
+        'records': records,
+        'correct': rets == [tv[2] for tv in vectors],
+    })
+
+def phase_order(phase):
+    if phase == 'list':
+        return 0
+    if phase == 'final':
+        return sys.maxint
+    return int(phase.split()[-1])
+
+def print_result(r):
+    print '%-8s %3d,%-2d %s %7.3f solves/s %7.3f solutions/s %8.1f MB' % (
+        r['solver'], r['n'], r['k'], 'ok  ' if r['correct'] else 'FAIL',
+        r['solves_per_sec'], r['solutions_per_sec'], r['peak_rss_mb'])
+    print '    ' + ', '.join('%s %.3fs' % (p, r['phases'][p])
+                             for p in sorted(r['phases'], key=phase_order))
+
+def bench(solvers, params, nonces, slow=False, ram_budget=None, tmp_dir=None):
+    '''Benchmarks each solver on the first few test vectors for each (n, k).
+
+    Each benchmark runs in its own process, so that peak memory use is
+    measured separately.'''
+    results = {}
+    test_vectors = zcash_test_vectors()
+    for n, k in params:
+        vectors = [tv[2:] for tv in test_vectors if tv[:2] == (n, k)][:nonces]
+        for name in solvers:
+            if name in SLOW_SOLVERS and (n, k) != PARAMS[0] and not slow:
+                continue
+            r = run_isolated(bench_solver, (name, n, k, vectors, ram_budget, tmp_dir))
+            if r is None:
+                print '%-8s %3d,%-2d failed' % (name, n, k)
+                continue
+            print_result(r)
+            results['%s %d,%d' % (name, n, k)] = r
+    return {
+        'host': platform.node(),
+        'cpus': multiprocessing.cpu_count(),
+        'results': results,
+    }
+
+def compare(report, baseline, tolerance):
+    '''Returns the benchmarks that are more than tolerance slower than in the
+    baseline, or are no longer correct.'''
+    regressions = []
+    for key, r in sorted(report['results'].items()):
+        if not r['correct']:
+            regressions.append('%s: incorrect solutions' % key)
+        b = baseline['results'].get(key)
+        if b and r['solves_per_sec'] < b['solves_per_sec']*(1-tolerance):
+            regressions.append('%s: %.3f solves/s, baseline %.3f solves/s' % (
+                key, r['solves_per_sec'], b['solves_per_sec']))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Equihash solvers')
+    parser.add_argument('-s', '--solver', action='append', choices=SOLVERS,
+                        help='a solver to benchmark (default: all)')
+    parser.add_argument('-p', '--params', action='append',
+                        help='an n,k parameter set to benchmark (default: %s)' %
+                        ' '.join('%d,%d' % p for p in PARAMS))
+    parser.add_argument('--nonces', type=int, default=2,
+                        help='number of test vectors to solve per parameter set')
+    parser.add_argument('--slow', action='store_true',
+                        help='also run the pure-Python solvers on large parameters')
+    parser.add_argument('--ram-budget', type=int, metavar='MIB',
+                        help='memory budget of the disk solver, in MiB (default: 256)')
+    parser.add_argument('--tmp-dir', metavar='DIR',
+                        help='keep the tables of the disk solver under DIR')
+    parser.add_argument('-o', '--output',
+                        help='write the results as JSON to this file')
+    parser.add_argument('-b', '--baseline',
+                        help='compare the results against this JSON file')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1,
+                        help='fraction of a slowdown to report as a regression')
+    args = parser.parse_args()
+
+    params = [tuple(int(x) for x in p.split(',')) for p in args.params] if args.params else PARAMS
+    # Only the parameter sets with test vectors can be timed
+    untested = [p for p in params if p not in [tv[:2] for tv in zcash_test_vectors()]]
+    if untested:
+        parser.error('no test vectors for %s' % ' '.join('%d,%d' % p for p in untested))
+    if args.nonces < 1:
+        parser.error('--nonces must be at least 1')
+    report = bench(args.solver or SOLVERS, params, args.nonces, args.slow,
+                   args.ram_budget << 20 if args.ram_budget is not None else None,
+                   args.tmp_dir)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for r in regressions:
+            print 'Regression: %s' % r
+        if regressions:
+            sys.exit(1)
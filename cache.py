@@ -0,0 +1,134 @@
+#!/usr/bin/env python2
+import os
+import struct
+import tempfile
+
+from backend import sha256
+from convert import (
+    get_indices_from_minimal,
+    get_minimal_from_indices,
+)
+
+# Default size limit of a SolutionCache, in bytes
+CACHE_SIZE = 64 << 20
+
+# Magic, n, k and number of solutions
+ENTRY_HEADER = struct.Struct('<4sIII')
+ENTRY_MAGIC = b'EHSC'
+CHECKSUM_SIZE = 32
+
+
+def encode_entry(n, k, solns):
+    '''Encodes a list of solutions in their minimal encoding, after a header
+    and followed by a SHA-256 checksum of both.'''
+    bit_len = n/(k+1) + 1
+    body = ENTRY_HEADER.pack(ENTRY_MAGIC, n, k, len(solns)) + b''.join(
+        bytes(get_minimal_from_indices(soln, bit_len)) for soln in solns)
+    return body + sha256(body).digest()
+
+def decode_entry(n, k, data):
+    '''Decodes the solutions in an entry written by encode_entry, raising
+    ValueError if it is corrupt or for other parameters.'''
+    body, checksum = data[:-CHECKSUM_SIZE], data[-CHECKSUM_SIZE:]
+    if len(body) < ENTRY_HEADER.size or sha256(body).digest() != checksum:
+        raise ValueError('Corrupt cache entry')
+    magic, entry_n, entry_k, count = ENTRY_HEADER.unpack(body[:ENTRY_HEADER.size])
+    if magic != ENTRY_MAGIC or (entry_n, entry_k) != (n, k):
+        raise ValueError('Cache entry is for other parameters')
+    bit_len = n/(k+1) + 1
+    size = bit_len*2**k/8
+    if len(body) != ENTRY_HEADER.size + count*size:
+        raise ValueError('Corrupt cache entry')
+    return [get_indices_from_minimal(bytearray(body[i:i+size]), bit_len)
+            for i in range(ENTRY_HEADER.size, len(body), size)]
+
+class SolutionCache(object):
+    '''An on-disk cache of the solutions found by solvers, with one file per
+    entry in the directory path.
+
+    Entries are keyed by the name of the solver, the parameters and
+    H(I||V). Once the entries take up more than max_size bytes, the least
+    recently used ones are evicted. Corrupt entries are treated as missing.'''
+    def __init__(self, path, max_size=CACHE_SIZE):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, name, n, k, digest):
+        '''Returns the path of the entry for H(I||V) = digest.'''
+        key = sha256(b'%s|%d|%d|' % (name, n, k) + digest.copy().digest())
+        return os.path.join(self.path, key.hexdigest())
+
+    def get(self, name, n, k, digest):
+        '''Returns the cached solutions, or None.'''
+        path = self.entry_path(name, n, k, digest)
+        try:
+            with open(path, 'rb') as f:
+                solns = decode_entry(n, k, f.read())
+        except IOError:
+            self.misses += 1
+            return None
+        except ValueError:
+            os.remove(path)
+            self.misses += 1
+            return None
+        # Mark the entry as recently used
+        os.utime(path, None)
+        self.hits += 1
+        return solns
+
+    def put(self, name, n, k, digest, solns):
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=self.path)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(encode_entry(n, k, solns))
+        # Readers never see a partly written entry
+        os.rename(tmp, self.entry_path(name, n, k, digest))
+        self.evict()
+
+    def evict(self):
+        '''Removes the least recently used entries until the rest fit in
+        max_size bytes.'''
+        entries = []
+        for name in os.listdir(self.path):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Evicted by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def wrap(self, solver, name=None):
+        '''Returns a solver that yields the solutions of solver, from the cache
+        if possible. Solutions are only cached once solver has found them
+        all.'''
+        if name is None:
+            name = solver.__name__
+        def cached_solver(digest, n, k, hook=None, **kwargs):
+            solns = self.get(name, n, k, digest)
+            if solns is not None:
+                for soln in solns:
+                    yield soln
+                return
+            state = digest.copy()
+            solns = []
+            for soln in solver(digest, n, k, hook=hook, **kwargs):
+                solns.append(soln)
+                yield soln
+            self.put(name, n, k, state, solns)
+        cached_solver.__name__ = name
+        return cached_solver
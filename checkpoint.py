@@ -0,0 +1,144 @@
+#!/usr/bin/env python2
+from array import array
+import os
+import struct
+import sys
+import tempfile
+
+from backend import sha256
+from pow import (
+    NONCE_STRUCT,
+    equihash_params,
+    pack_nonce,
+)
+
+# Magic, n, k, previous block hash, nonce, H(I||V) key, max_pairs, rounds
+# completed and list length
+CHECKPOINT_HEADER = struct.Struct('<4sII32s32s32sIII')
+CHECKPOINT_MAGIC = b'EHCK'
+CHECKSUM_SIZE = 32
+
+# Entries written at a time
+CHUNK_SIZE = 1 << 14
+
+NO_HASH = b'\0'*32
+
+
+def unpack_nonce(data):
+    return sum(x << (32*i) for i, x in enumerate(NONCE_STRUCT.unpack(data)))
+
+def digest_key(digest):
+    '''Identifies a solve by its H(I||V) state, without consuming it.'''
+    return sha256(digest.copy().digest()).digest()
+
+def index_array(data):
+    indices = array('I')
+    indices.fromstring(data)
+    if sys.byteorder == 'big':
+        indices.byteswap()
+    return indices
+
+class Checkpoint(object):
+    '''A file recording the progress of a miner: the block it is mining, the
+    nonce it is trying, and the list after the last round the solver
+    completed for that nonce.
+
+    The file is replaced atomically each time it is saved, and ends with a
+    SHA-256 checksum. A file that is corrupt or for other parameters is
+    treated as missing.'''
+    def __init__(self, path):
+        self.path = path
+        self.n = self.k = None
+        self.prev_hash = NO_HASH
+        self.nonce = 0
+        # The contents of the file read by resume, until the solver loads them
+        self.pending = None
+
+    def read(self, n, k):
+        '''Returns the header fields and the list of the file, or None.'''
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            return None
+        body, checksum = data[:-CHECKSUM_SIZE], data[-CHECKSUM_SIZE:]
+        if len(body) < CHECKPOINT_HEADER.size or sha256(body).digest() != checksum:
+            return None
+        fields = CHECKPOINT_HEADER.unpack(body[:CHECKPOINT_HEADER.size])
+        if fields[:3] != (CHECKPOINT_MAGIC, n, k):
+            return None
+        return fields, buffer(body, CHECKPOINT_HEADER.size)
+
+    def write(self, key=NO_HASH, max_pairs=0, rounds=0, X=()):
+        fd, tmp = tempfile.mkstemp(prefix='.', dir=os.path.dirname(self.path) or '.')
+        checksum = sha256()
+        with os.fdopen(fd, 'wb') as f:
+            def write(data):
+                checksum.update(data)
+                f.write(data)
+            write(CHECKPOINT_HEADER.pack(
+                CHECKPOINT_MAGIC, self.n, self.k, self.prev_hash,
+                pack_nonce(self.nonce), key, max_pairs, rounds, len(X)))
+            # The hashes, then the indices of every entry
+            for i in xrange(0, len(X), CHUNK_SIZE):
+                write(b''.join(bytes(h) for h, _ in X[i:i+CHUNK_SIZE]))
+            for i in xrange(0, len(X), CHUNK_SIZE):
+                indices = array('I')
+                for _, t in X[i:i+CHUNK_SIZE]:
+                    indices.extend(t)
+                if sys.byteorder == 'big':
+                    indices.byteswap()
+                write(indices.tostring())
+            f.write(checksum.digest())
+        # A restarted miner never sees a partly written checkpoint
+        os.rename(tmp, self.path)
+
+    def resume(self, n, k):
+        '''Returns the (previous block hash, nonce) the miner was at, or
+        None if there is no checkpoint for (n, k).'''
+        contents = self.read(n, k)
+        if contents is None:
+            return None
+        self.pending = contents
+        fields = contents[0]
+        self.n, self.k, self.prev_hash = n, k, fields[3]
+        self.nonce = unpack_nonce(fields[4])
+        return self.prev_hash, self.nonce
+
+    def start(self, n, k, prev_hash, nonce):
+        '''Records that the miner is starting on nonce for the block after
+        prev_hash. The saved list is kept if it is for that nonce.'''
+        if (n, k, prev_hash, nonce) == (self.n, self.k, self.prev_hash, self.nonce):
+            return
+        self.n, self.k, self.prev_hash, self.nonce = n, k, prev_hash, nonce
+        self.pending = None
+        self.write()
+
+    def load_table(self, digest, n, k, max_pairs=0):
+        '''Returns (rounds completed, list) saved for the solve of H(I||V) =
+        digest with the same pruning, or None.'''
+        contents = self.pending or self.read(n, k)
+        self.pending = None
+        if contents is None:
+            return None
+        fields, table = contents
+        key, saved_pairs, rounds, count = fields[5:]
+        if key != digest_key(digest) or saved_pairs != max_pairs or not rounds:
+            return None
+        hash_length = equihash_params(n, k).hash_length
+        size = 2**rounds
+        indices = index_array(table[count*hash_length:])
+        if len(indices) != count*size:
+            return None
+        return rounds, [
+            (bytearray(table[j*hash_length:(j+1)*hash_length]),
+             tuple(indices[j*size:(j+1)*size]))
+            for j in xrange(count)]
+
+    def save_table(self, digest, n, k, rounds, X, max_pairs=0):
+        '''Saves the list X after the given number of rounds of the solve of
+        H(I||V) = digest.'''
+        if (n, k) != (self.n, self.k):
+            # Not started by a miner
+            self.n, self.k, self.prev_hash, self.nonce = n, k, NO_HASH, 0
+        self.write(digest_key(digest), max_pairs, rounds, X)
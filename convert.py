@@ -1,5 +1,10 @@
 #!/usr/bin/env python2
 import binascii
+import struct
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 word_size = 32
 word_mask = (1<<word_size)-1
@@ -73,3 +78,51 @@ def compress_array(inp, out_len, bit_len, byte_pad=0):
         out[i] = (acc_value >> acc_bits) & 0xFF
 
     return out
+
+def get_indices_from_minimal(minimal, bit_len):
+    eh_index_size = 4
+    assert (bit_len+7)/8 <= eh_index_size
+    len_indices = 8*eh_index_size*len(minimal)/bit_len
+    byte_pad = eh_index_size - (bit_len+7)/8
+    expanded = expand_array(minimal, len_indices, bit_len, byte_pad)
+    return [struct.unpack('>I', expanded[i:i+4])[0] for i in range(0, len_indices, eh_index_size)]
+
+def get_minimal_from_indices(indices, bit_len):
+    eh_index_size = 4
+    assert (bit_len+7)/8 <= eh_index_size
+    len_indices = len(indices)*eh_index_size
+    min_len = bit_len*len_indices/(8*eh_index_size)
+    byte_pad = eh_index_size - (bit_len+7)/8
+    expanded = bytearray(struct.pack('>%dI' % len(indices), *indices))
+    return compress_array(expanded, min_len, bit_len, byte_pad)
+
+def expand_arrays(inp, out_len, bit_len, byte_pad=0):
+    '''Vectorized expand_array of every row of the 2-D buffer inp.'''
+    assert bit_len >= 8 and word_size >= 7+bit_len
+    inp = np.asarray(inp, dtype=np.uint8)
+    rows, in_len = inp.shape
+
+    out_width = (bit_len+7)/8 + byte_pad
+    assert out_len == 8*out_width*in_len/bit_len
+    num = out_len/out_width
+
+    # Right-align each bit_len-bit element in 8*out_width bits
+    bits = np.zeros((rows, num, 8*out_width), dtype=np.uint8)
+    bits[:, :, 8*out_width-bit_len:] = np.unpackbits(inp, axis=1)[
+        :, :num*bit_len].reshape(rows, num, bit_len)
+    return np.packbits(bits, axis=2).reshape(rows, out_len)
+
+def compress_arrays(inp, out_len, bit_len, byte_pad=0):
+    '''Vectorized compress_array of every row of the 2-D buffer inp.'''
+    assert bit_len >= 8 and word_size >= 7+bit_len
+    inp = np.asarray(inp, dtype=np.uint8)
+    rows, in_len = inp.shape
+
+    in_width = (bit_len+7)/8 + byte_pad
+    assert out_len == bit_len*in_len/(8*in_width)
+    num = in_len/in_width
+
+    # Take the bit_len least-significant bits of each element
+    bits = np.unpackbits(inp.reshape(rows, num, in_width), axis=2)[
+        :, :, 8*in_width-bit_len:].reshape(rows, num*bit_len)
+    return np.packbits(bits[:, :8*out_len], axis=1)
@@ -1,38 +1,121 @@
 #!/usr/bin/env python2
 import argparse
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import hashes
+from array import array
+from binascii import hexlify
 from datetime import datetime
+from functools import partial
+from itertools import groupby, islice, izip
+import json
+import multiprocessing
 from operator import itemgetter
-from pyblake2 import blake2b
+from Queue import Empty
+import os
+import resource
+import signal
 import struct
+import sys
+import threading
+import time
 
+from backend import (
+    backend_name,
+    blake2b,
+    sha256,
+)
 from convert import (
     compress_array,
     expand_array,
+    expand_arrays,
 )
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 DEBUG = False
 VERBOSE = False
 progressbar = None
 
+# Number of hash outputs generated per batch in step 1
+HASH_BATCH_SIZE = 1 << 12
+
+# Default number of pairs taken from each bucket when pruning
+PRUNE_MAX_PAIRS = 32
+
+# Default number of first lists the pipelined miner builds ahead
+PIPELINE_DEPTH = 2
+
+NONCE_STRUCT = struct.Struct('<8I')
+NONCE_PADDING = b'\0'*24
+
+
+class EquihashParams(object):
+    '''The Equihash parameters n and k, validated once, along with the values
+    derived from them and the initial state of H(...).
+
+    The digest state after the last header hashed is cached, so that trying
+    many nonces for the same header only costs a copy and one update each.'''
+    def __init__(self, n, k):
+        validate_params(n, k)
+        self.n = n
+        self.k = k
+        self.collision_length = n/(k+1)
+        self.hash_length = (k+1)*((self.collision_length+7)//8)
+        self.indices_per_hash_output = 512/n
+        self.list_length = 2**(self.collision_length+1)
+        self.person = zcash_person(n, k)
+        self.base = blake2b(digest_size=self.indices_per_hash_output*n/8,
+                            person=self.person)
+        self.header = None
+        self.header_state = None
+
+    def __repr__(self):
+        return 'EquihashParams(%d, %d)' % (self.n, self.k)
+
+    def header_digest(self, header):
+        '''Returns a new digest state for H(I||..., with I = header.'''
+        if header != self.header:
+            self.header_state = self.base.copy()
+            self.header_state.update(header)
+            self.header = header
+        return self.header_state.copy()
+
+    def nonce_digest(self, header, nonce):
+        '''Returns a new digest state for H(I||V||..., with I = header and
+        V = nonce.'''
+        digest = self.header_digest(header)
+        digest.update(pack_nonce(nonce))
+        return digest
+
+# Parameter sets in use, by (n, k)
+PARAMS = {}
+
+def equihash_params(n, k):
+    '''Returns the EquihashParams for (n, k), creating them on first use.'''
+    params = PARAMS.get((n, k))
+    if params is None:
+        params = PARAMS[(n, k)] = EquihashParams(n, k)
+    return params
+
+def pack_nonce(nonce):
+    '''Encodes nonce as a 256-bit little-endian integer.'''
+    if nonce >> 64 == 0:
+        # Nonces used in practice fit in the first 64 bits
+        return struct.pack('<Q', nonce) + NONCE_PADDING
+    return NONCE_STRUCT.pack(*[(nonce >> (32*i)) & 0xffffffff for i in range(8)])
 
 def hash_nonce(digest, nonce):
-    for i in range(8):
-        digest.update(struct.pack('<I', nonce >> (32*i)))
+    digest.update(pack_nonce(nonce))
 
 def hash_xi(digest, xi):
     digest.update(struct.pack('<I', xi))
     return digest # For chaining
 
 def count_zeroes(h):
-    # Convert to binary string
-    if type(h) == bytearray:
-        h = ''.join('{0:08b}'.format(x, 'b') for x in h)
-    else:
-        h = ''.join('{0:08b}'.format(ord(x), 'b') for x in h)
-    # Count leading zeroes
-    return (h+'1').index('1')
+    # Count leading zeroes of h as a big-endian integer
+    if not h:
+        return 0
+    return 8*len(h) - int(hexlify(h), 16).bit_length()
 
 def has_collision(ha, hb, i, l):
     res = [ha[j] == hb[j] for j in range((i-1)*l/8, i*l/8)]
@@ -48,34 +131,247 @@ def distinct_indices(a, b):
 def xor(ha, hb):
     return bytearray(a^b for a,b in zip(ha,hb))
 
-def gbp_basic(digest, n, k):
-    '''Implementation of Basic Wagner's algorithm for the GBP.'''
-    collision_length = n/(k+1)
-    hash_length = (k+1)*((collision_length+7)//8)
-    indices_per_hash_output = 512/n
+def collision_bucket(h, i, l):
+    # Expanded chunks are (l+7)/8 bytes wide, with the l bits right-aligned
+    width = (l+7)/8
+    b = 0
+    for x in h[(i-1)*width:i*width]:
+        b = (b << 8) | x
+    return b
+
+def bucket_sort(X, i, l):
+    '''Counting sort of X into 2^l buckets on the i-th collision chunk.
+
+    Returns the sorted list, and the start offset of each bucket within it.'''
+    keys = array('I', [collision_bucket(Xi[0], i, l) for Xi in X])
+    starts = array('I', [0])*(2**l+1)
+    for b in keys:
+        starts[b+1] += 1
+    for b in xrange(2**l):
+        starts[b+1] += starts[b]
+    pos = starts[:-1]
+    out = [None]*len(X)
+    for Xi, b in izip(X, keys):
+        out[pos[b]] = Xi
+        pos[b] += 1
+    return out, starts
+
+def hash_xis(digest, start, end):
+    '''Returns H(I||V||x) for every x in [start, end), concatenated.'''
+    pack = struct.Struct('<I').pack
+    copy = digest.copy
+    out = []
+    for xi in xrange(start, end):
+        curr_digest = copy()
+        curr_digest.update(pack(xi))
+        out.append(curr_digest.digest())
+    return b''.join(out)
+
+def round_stats(size, prune=False):
+    '''Returns the empty statistics a solver collects for a hook over one
+    round of a list of the given size.'''
+    stats = {'size': size, 'buckets': {}, 'pairs': 0, 'dropped': 0}
+    if prune:
+        stats.update(capped=0, zeros=0)
+    return stats
+
+def add_round_stats(stats, other):
+    '''Adds the statistics of part of a round to those of the whole round.'''
+    for size, count in other['buckets'].items():
+        stats['buckets'][size] = stats['buckets'].get(size, 0) + count
+    stats['pairs'] += other['pairs']
+    stats['dropped'] += other['dropped']
+
+def add_bucket(stats, j):
+    '''Adds a bucket of j colliding entries, and its pairs, to stats if given.'''
+    if stats is not None:
+        stats['buckets'][j] = stats['buckets'].get(j, 0) + 1
+        stats['pairs'] += j*(j-1)/2
+
+def prune_pairs(j, max_pairs, stats):
+    '''Returns the (l, m) offsets of the unordered pairs in a bucket of j
+    entries, at most max_pairs of them if that is set. If given, the pairs
+    left out are counted in stats.
+
+    When capped, the pairs are taken by distance within the bucket, adjacent
+    ones first, so that every entry is used rather than only the first few.'''
+    pairs = ((l, m) for l in range(0, j-1) for m in range(l+1, j))
+    if max_pairs is not None and j*(j-1)/2 > max_pairs:
+        pairs = islice(((l, l+dist) for dist in range(1, j) for l in range(0, j-dist)),
+                       max_pairs)
+        if stats is not None:
+            stats['capped'] += 1
+            stats['dropped'] += j*(j-1)/2 - max_pairs
+    return pairs
+
+def collide_bucket(bucket, max_pairs=None, stats=None):
+    '''Returns the (X_i ^ X_j, indices) entries for the pairs of (hash, indices)
+    entries in bucket, which all collide, whose indices are distinct. indices
+    are those of both entries, ordered by their first index.
+
+    If max_pairs is set, the bucket is pruned: at most max_pairs pairs are
+    taken, and entries that XOR to zero are dropped. If given, the bucket is
+    added to stats.'''
+    if not bucket:
+        return []
+    add_bucket(stats, len(bucket))
+    Xc = []
+    for l, m in prune_pairs(len(bucket), max_pairs, stats):
+        res = xor(bucket[l][0], bucket[m][0])
+        # Entries that XOR to zero can only lead to duplicate indices, so
+        # drop them before the costlier check
+        if max_pairs is not None and not any(res):
+            if stats is not None:
+                stats['zeros'] += 1
+                stats['dropped'] += 1
+            continue
+        # Check that there are no duplicate indices in tuples i and j
+        if distinct_indices(bucket[l][1], bucket[m][1]):
+            if bucket[l][1][0] < bucket[m][1][0]:
+                concat = bucket[l][1] + bucket[m][1]
+            else:
+                concat = bucket[m][1] + bucket[l][1]
+            Xc.append((res, concat))
+        elif stats is not None:
+            stats['dropped'] += 1
+    return Xc
+
+def join_final(X, max_pairs=None, stats=None):
+    '''Final round of Wagner's algorithm over the list X of (hash, indices)
+    entries. Yields the indices of each pair of entries whose hashes XOR to
+    zero and whose indices are distinct, ordered by their first index.
+
+    The entries are hash-joined on their hashes as ints. All but the last
+    2n/(k+1) bits of these are zero, so entries that share one collide on
+    those bits. If given, at most max_pairs pairs are taken from each bucket,
+    and the bucket sizes, pairs and pairs dropped are added to stats.'''
+    buckets = {}
+    for Xi in X:
+        buckets.setdefault(int(hexlify(Xi[0]), 16), []).append(Xi)
+    for bucket in buckets.itervalues():
+        add_bucket(stats, len(bucket))
+        for l, m in prune_pairs(len(bucket), max_pairs, stats):
+            a, b = bucket[l][1], bucket[m][1]
+            if distinct_indices(a, b):
+                if DEBUG and VERBOSE:
+                    print 'Found solution:'
+                    print '- %s %s' % (print_hash(bucket[l][0]), a)
+                    print '- %s %s' % (print_hash(bucket[m][0]), b)
+                yield list(a + b) if a[0] < b[0] else list(b + a)
+            elif stats is not None:
+                stats['dropped'] += 1
+
+def phase_record(phase, start, stats=None):
+    '''Returns the record a solver passes to its hook at the end of a phase
+    that began at time start, with the given statistics.'''
+    record = {
+        'phase': phase,
+        'seconds': time.time() - start,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if stats:
+        record.update(stats)
+    return record
+
+def iter_table(digest, n, k):
+    '''Yields the expanded hashes of the first list in batches, each one a
+    contiguous buffer with hash_length bytes per entry.'''
+    params = equihash_params(n, k)
+    collision_length = params.collision_length
+    hash_length = params.hash_length
+    indices_per_hash_output = params.indices_per_hash_output
+    list_length = params.list_length
+    num_hashes = (list_length+indices_per_hash_output-1)/indices_per_hash_output
 
-    # 1) Generate first list
-    if DEBUG: print 'Generating first list'
-    X = []
-    tmp_hash = ''
     if DEBUG and progressbar: bar = progressbar.ProgressBar()
     else: bar = lambda x: x
-    for i in bar(range(0, 2**(collision_length+1))):
-        r = i % indices_per_hash_output
-        if r == 0:
-            # X_i = H(I||V||x_i)
-            curr_digest = digest.copy()
-            hash_xi(curr_digest, i/indices_per_hash_output)
-            tmp_hash = curr_digest.digest()
-        X.append((
-            expand_array(bytearray(tmp_hash[r*n/8:(r+1)*n/8]),
-                         hash_length, collision_length),
-            (i,)
-        ))
+    for i in bar(range(0, num_hashes, HASH_BATCH_SIZE)):
+        # X_i = H(I||V||x_i), for a batch of indices_per_hash_output*HASH_BATCH_SIZE
+        # values of i at once
+        tmp_hash = bytearray(hash_xis(digest, i, min(i+HASH_BATCH_SIZE, num_hashes)))
+        # The outputs hold consecutive n-bit hashes, so expand them in one pass
+        if np is not None:
+            expanded = expand_arrays(
+                np.frombuffer(tmp_hash, dtype=np.uint8).reshape(-1, n/8),
+                hash_length, collision_length).tobytes()
+        elif n % (k+1) == 0:
+            expanded = expand_array(tmp_hash, len(tmp_hash)*hash_length*8/n,
+                                    collision_length)
+        else:
+            # The last chunk of each hash is shorter than the others, so the
+            # hashes cannot be expanded as one stream
+            expanded = bytearray().join(
+                expand_array(tmp_hash[j:j+n/8], hash_length, collision_length)
+                for j in xrange(0, len(tmp_hash), n/8))
+        # The last output may hold more hashes than are needed
+        start = i*indices_per_hash_output*hash_length
+        yield expanded[:list_length*hash_length-start]
+
+def generate_table(digest, n, k):
+    '''Returns the expanded hashes of the first list as one contiguous buffer,
+    with hash_length bytes per entry.'''
+    table = bytearray()
+    for batch in iter_table(digest, n, k):
+        table += batch
+    return table
+
+def generate_list(digest, n, k, table=None):
+    hash_length = equihash_params(n, k).hash_length
+
+    if table is None:
+        if DEBUG: print 'Generating first list'
+        table = generate_table(digest, n, k)
+    else:
+        # Built ahead by a producer
+        table = bytearray(table)
+    return [(table[i:i+hash_length], (i/hash_length,))
+            for i in xrange(0, len(table), hash_length)]
+
+def initial_list(digest, n, k, hook, checkpoint, max_pairs, table):
+    '''Returns the first round still to be done, and the list it starts from:
+    the one saved in checkpoint for this solve if there is one, or else the
+    first list, converted from table if given.'''
+    start = time.time()
+    saved = checkpoint.load_table(digest, n, k, max_pairs or 0) if checkpoint else None
+    if saved:
+        rounds, X = saved
+        if hook: hook(phase_record('resume', start, {'size': len(X), 'round': rounds}))
+        return rounds+1, X
+    X = generate_list(digest, n, k, table)
+    if hook: hook(phase_record('list', start, {'size': len(X)}))
+    return 1, X
+
+def iter_solutions(digest, n, k, hook=None, prune=False, max_pairs=PRUNE_MAX_PAIRS,
+                   checkpoint=None, table=None):
+    '''Implementation of Basic Wagner's algorithm for the GBP, as a generator.
+
+    Each solution is yielded as soon as it is found, and no further work is
+    done once the generator is closed. If given, hook is called with a
+    phase_record as each phase of the algorithm ends.
+
+    If prune is set, entries whose hash XORs to zero are dropped as they are
+    created, and at most max_pairs pairs are taken from each bucket. This
+    bounds the size of each round at the cost of some solutions; the records
+    count the buckets that were capped and the zero entries dropped.
+
+    If checkpoint is given, the list is saved there at the end of each round,
+    and a solve of the same H(I||V) resumes from the last round saved.
+
+    If given, table is the first list as returned by generate_table, built
+    ahead of time.'''
+    params = equihash_params(n, k)
+    collision_length = params.collision_length
+    if not prune:
+        max_pairs = None
+
+    # 1) Generate first list
+    first, X = initial_list(digest, n, k, hook, checkpoint, max_pairs, table)
 
     # 3) Repeat step 2 until 2n/(k+1) bits remain
-    for i in range(1, k):
+    for i in range(first, k):
         if DEBUG: print 'Round %d:' % i
+        start = time.time()
+        stats = round_stats(len(X), prune) if hook else None
 
         # 2a) Sort the list
         if DEBUG: print '- Sorting list'
@@ -98,15 +394,7 @@ def gbp_basic(digest, n, k):
                 j += 1
 
             # 2c) Store tuples (X_i ^ X_j, (i, j)) on the table
-            for l in range(0, j-1):
-                for m in range(l+1, j):
-                    # Check that there are no duplicate indices in tuples i and j
-                    if distinct_indices(X[-1-l][1], X[-1-m][1]):
-                        if X[-1-l][1][0] < X[-1-m][1][0]:
-                            concat = X[-1-l][1] + X[-1-m][1]
-                        else:
-                            concat = X[-1-m][1] + X[-1-l][1]
-                        Xc.append((xor(X[-1-l][0], X[-1-m][0]), concat))
+            Xc.extend(collide_bucket(X[-j:][::-1], max_pairs, stats))
 
             # 2d) Drop this set
             while j > 0:
@@ -116,66 +404,238 @@ def gbp_basic(digest, n, k):
         if DEBUG and progressbar: pbar.finish()
         # 2e) Replace previous list with new list
         X = Xc
+        if checkpoint: checkpoint.save_table(digest, n, k, i, X, max_pairs or 0)
+        if hook: hook(phase_record('round %d' % i, start, stats))
 
     # k+1) Find a collision on last 2n(k+1) bits
-    if DEBUG:
-        print 'Final round:'
-        print '- Sorting list'
-    X.sort(key=itemgetter(0))
-    if DEBUG and VERBOSE:
-        for Xi in X[-32:]:
-            print '%s %s' % (print_hash(Xi[0]), Xi[1])
-    if DEBUG: print '- Finding collisions'
-    solns = []
-    if DEBUG and progressbar:
-        orig_size = len(X)
-        pbar = progressbar.ProgressBar(max_value=orig_size, redirect_stdout=True)
-    while len(X) > 0:
-        j = 1
-        while j < len(X):
-            if not (has_collision(X[-1][0], X[-1-j][0], k, collision_length) and
-                    has_collision(X[-1][0], X[-1-j][0], k+1, collision_length)):
-                break
-            j += 1
-
-        for l in range(0, j-1):
-            for m in range(l+1, j):
-                res = xor(X[-1-l][0], X[-1-m][0])
-                if count_zeroes(res) == 8*hash_length and distinct_indices(X[-1-l][1], X[-1-m][1]):
-                    if DEBUG and VERBOSE:
-                        print 'Found solution:'
-                        print '- %s %s' % (print_hash(X[-1-l][0]), X[-1-l][1])
-                        print '- %s %s' % (print_hash(X[-1-m][0]), X[-1-m][1])
-                    if X[-1-l][1][0] < X[-1-m][1][0]:
-                        solns.append(list(X[-1-l][1] + X[-1-m][1]))
-                    else:
-                        solns.append(list(X[-1-m][1] + X[-1-l][1]))
-
-        # 2d) Drop this set
-        while j > 0:
-            X.pop(-1)
-            j -= 1
-        if DEBUG and progressbar: pbar.update(orig_size - len(X))
-    if DEBUG and progressbar: pbar.finish()
+    if DEBUG: print 'Final round:'
+    start = time.time()
+    stats = round_stats(len(X), prune) if hook else None
+    for soln in join_final(X, max_pairs, stats):
+        yield soln
+    if hook: hook(phase_record('final', start, stats))
+
+def gbp_basic(digest, n, k, hook=None, prune=False, max_pairs=PRUNE_MAX_PAIRS,
+              checkpoint=None, table=None):
+    '''Implementation of Basic Wagner's algorithm for the GBP.'''
+    return list(iter_solutions(digest, n, k, hook, prune, max_pairs, checkpoint, table))
+
+def gbp_bucketed(digest, n, k, hook=None, prune=False, max_pairs=PRUNE_MAX_PAIRS,
+                 checkpoint=None, table=None):
+    '''Implementation of Basic Wagner's algorithm for the GBP, with the
+    sorting steps replaced by distributing the list into 2^(n/(k+1)) buckets.
+
+    prune, max_pairs, checkpoint and table are as for iter_solutions.'''
+    params = equihash_params(n, k)
+    collision_length = params.collision_length
+    if not prune:
+        max_pairs = None
+
+    # 1) Generate first list
+    first, X = initial_list(digest, n, k, hook, checkpoint, max_pairs, table)
+
+    # 3) Repeat step 2 until 2n/(k+1) bits remain
+    for i in range(first, k):
+        if DEBUG: print 'Round %d:' % i
+        start = time.time()
+        stats = round_stats(len(X), prune) if hook else None
+
+        # 2a) Distribute the list into buckets on the next n/(k+1) bits
+        if DEBUG: print '- Bucketing list'
+        X, starts = bucket_sort(X, i, collision_length)
+
+        if DEBUG: print '- Finding collisions'
+        Xc = []
+        for b in xrange(2**collision_length):
+            # 2b) Every unordered pair within a bucket collides
+            # 2c) Store tuples (X_i ^ X_j, (i, j)) on the table
+            Xc.extend(collide_bucket(X[starts[b]:starts[b+1]], max_pairs, stats))
+        # 2e) Replace previous list with new list
+        X = Xc
+        if checkpoint: checkpoint.save_table(digest, n, k, i, X, max_pairs or 0)
+        if hook: hook(phase_record('round %d' % i, start, stats))
+
+    # k+1) Find a collision on last 2n(k+1) bits
+    if DEBUG: print 'Final round:'
+    start = time.time()
+    stats = round_stats(len(X), prune) if hook else None
+    solns = list(join_final(X, max_pairs, stats))
+    if hook: hook(phase_record('final', start, stats))
+    return solns
+
+def packed_list(digest, n, k, table=None):
+    '''Returns the first list as a list of ints, one per expanded hash, and
+    an array of their indices.'''
+    params = equihash_params(n, k)
+    hash_length = params.hash_length
+    if table is None:
+        if DEBUG: print 'Generating first list'
+        table = generate_table(digest, n, k)
+    X = [int(hexlify(table[j:j+hash_length]), 16)
+         for j in xrange(0, len(table), hash_length)]
+    return X, array('I', xrange(len(X)))
+
+def packed_collisions(X, I, size, shift, stats=None):
+    '''Yields (a, b, indices) for each pair of entries of X whose values agree
+    above bit shift, and whose size indices in I are distinct. indices are
+    those of both entries, ordered by their first index.
+
+    If given, the bucket sizes, pairs and pairs dropped are added to stats.'''
+    order = sorted(xrange(len(X)), key=X.__getitem__)
+    for _, bucket in groupby(order, key=lambda j: X[j] >> shift):
+        bucket = list(bucket)
+        add_bucket(stats, len(bucket))
+        for l, a in enumerate(bucket):
+            ia = I[a*size:(a+1)*size]
+            seen = set(ia)
+            for b in bucket[l+1:]:
+                ib = I[b*size:(b+1)*size]
+                if seen.isdisjoint(ib):
+                    yield a, b, ia + ib if ia[0] < ib[0] else ib + ia
+                elif stats is not None:
+                    stats['dropped'] += 1
+
+def gbp_packed(digest, n, k, hook=None, table=None):
+    '''Implementation of Basic Wagner's algorithm for the GBP, without NumPy.
+
+    Each expanded hash is packed into a single int, so collisions are found by
+    sorting the ints and comparing them shifted, and combined with a single
+    XOR. The indices of the list are kept in one flat array of 32-bit values,
+    with 2^(i-1) of them per entry in round i. table is as for
+    iter_solutions.'''
+    params = equihash_params(n, k)
+    hash_length = params.hash_length
+    width = (params.collision_length+7)/8
+
+    # 1) Generate first list
+    start = time.time()
+    X, I = packed_list(digest, n, k, table)
+    if hook: hook(phase_record('list', start, {'size': len(X)}))
+
+    # 3) Repeat step 2 until 2n/(k+1) bits remain
+    for i in range(1, k):
+        if DEBUG: print 'Round %d:' % i
+        start = time.time()
+        stats = round_stats(len(X)) if hook else None
+        # 2a-b) Sort the list, and find the collisions on the i-th chunk.
+        # Earlier chunks are zero, so this is everything above it
+        Xc = []
+        Ic = array('I')
+        for a, b, indices in packed_collisions(X, I, 2**(i-1), 8*(hash_length - i*width),
+                                               stats):
+            # 2c) Store tuples (X_i ^ X_j, (i, j)) on the table
+            Xc.append(X[a] ^ X[b])
+            Ic.extend(indices)
+        # 2e) Replace previous list with new list
+        X, I = Xc, Ic
+        if hook: hook(phase_record('round %d' % i, start, stats))
+
+    # k+1) Find a collision on last 2n(k+1) bits, which is all that is left
+    if DEBUG: print 'Final round:'
+    start = time.time()
+    stats = round_stats(len(X)) if hook else None
+    solns = [indices.tolist() for _, _, indices in
+             packed_collisions(X, I, 2**(k-1), 0, stats)]
+    if hook: hook(phase_record('final', start, stats))
     return solns
 
 def block_hash(prev_hash, nonce, soln):
     # H(I||V||x_1||x_2||...|x_2^k)
-    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-    digest.update(prev_hash)
+    digest = sha256(prev_hash)
     hash_nonce(digest, nonce)
-    for xi in soln:
-        hash_xi(digest, xi)
-    h = digest.finalize()
-    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-    digest.update(h)
-    return digest.finalize()
+    # Equivalent to hash_xi for each index
+    digest.update(struct.pack('<%dI' % len(soln), *soln))
+    return sha256(digest.digest()).digest()
 
 def difficulty_filter(prev_hash, nonce, soln, d):
-    h = block_hash(prev_hash, nonce, soln)
-    count = count_zeroes(h)
-    if DEBUG: print 'Leading zeroes: %d' % count
-    return count >= d
+    return difficulty_filter_batch(prev_hash, nonce, [soln], d)[0]
+
+def difficulty_filter_batch(prev_hash, nonce, solns, d):
+    '''Batch variant of difficulty_filter, taking the solutions solns for one
+    header and nonce and returning a list of results.'''
+    return [passed for _, passed in iter_difficulty(prev_hash, nonce, solns, d)]
+
+def iter_difficulty(prev_hash, nonce, solns, d):
+    '''Yields (soln, whether it passes the difficulty filter) for each of the
+    solutions solns for one header and nonce, as they arrive. The solutions
+    share the state of H(I||V||...'''
+    digest = sha256(prev_hash)
+    hash_nonce(digest, nonce)
+    for soln in solns:
+        curr_digest = digest.copy()
+        curr_digest.update(struct.pack('<%dI' % len(soln), *soln))
+        count = count_zeroes(sha256(curr_digest.digest()).digest())
+        if DEBUG: print 'Leading zeroes: %d' % count
+        yield soln, count >= d
+
+def is_gbp_solution(digest, n, k, soln):
+    '''Checks that soln is a solution to the GBP for H(I||V||...) = digest.'''
+    params = equihash_params(n, k)
+    collision_length = params.collision_length
+    indices_per_hash_output = params.indices_per_hash_output
+
+    if len(soln) != 2**k:
+        return False
+    if min(soln) < 0 or max(soln) >= params.list_length:
+        return False
+    if len(set(soln)) != len(soln):
+        return False
+    # Each pair of subtrees must be ordered by their first index
+    for r in range(1, k+1):
+        w = 2**(r-1)
+        for j in range(0, len(soln), 2*w):
+            if soln[j] >= soln[j+w]:
+                return False
+
+    # X_i = H(I||V||x_i), as integers of the (k+1)*collision_length leading
+    # bits of each n-bit hash, which are all that the solvers expand.
+    # Consecutive indices share the same hash output.
+    unused_bits = n % (k+1)
+    outputs = {}
+    X = []
+    for xi in soln:
+        g = xi / indices_per_hash_output
+        if g not in outputs:
+            outputs[g] = hash_xi(digest.copy(), g).digest()
+        r = xi % indices_per_hash_output
+        X.append(int(hexlify(outputs[g][r*n/8:(r+1)*n/8]), 16) >> unused_bits)
+
+    # Each pair of subtrees must collide on the next n/(k+1) bits, and the
+    # last pair on the remaining 2n/(k+1) bits
+    for r in range(1, k+1):
+        shift = (k+1-r)*collision_length if r < k else 0
+        Xc = []
+        for j in range(0, len(X), 2):
+            res = X[j] ^ X[j+1]
+            if res >> shift:
+                return False
+            Xc.append(res)
+        X = Xc
+    return True
+
+def verify_solution(n, k, header, nonce, soln, d=0):
+    '''Checks that soln is a valid solution for the given header and nonce,
+    including the difficulty filter.'''
+    digest = equihash_params(n, k).nonce_digest(header, nonce)
+    return (is_gbp_solution(digest, n, k, soln) and
+            difficulty_filter(header, nonce, soln, d))
+
+def verify_solutions(n, k, solutions, d=0):
+    '''Batch variant of verify_solution, taking an iterable of
+    (header, nonce, soln) tuples and returning a list of results.
+
+    Consecutive solutions for the same header and nonce share their digest
+    state.'''
+    params = equihash_params(n, k)
+    prev = None
+    ret = []
+    for header, nonce, soln in solutions:
+        if (header, nonce) != prev:
+            digest = params.nonce_digest(header, nonce)
+            prev = (header, nonce)
+        ret.append(is_gbp_solution(digest, n, k, soln) and
+                   difficulty_filter(header, nonce, soln, d))
+    return ret
 
 
 #
@@ -197,57 +657,329 @@ def validate_params(n, k):
     if (((n/(k+1))+1) >= 32):
         raise ValueError('Parameters must satisfy n/(k+1)+1 < 32')
 
-def mine(n, k, d):
+SOLVERS = ['basic', 'bucketed', 'packed', 'numpy', 'tree', 'sharded', 'disk']
+
+# Solvers that support pruning
+PRUNING_SOLVERS = ['basic', 'bucketed']
+
+# Solvers that can save and resume their rounds
+CHECKPOINT_SOLVERS = ['basic', 'bucketed']
+
+# Solvers that start their own worker processes, so cannot be run in the
+# miner's daemonic workers
+POOL_SOLVERS = ['sharded']
+
+# Solvers that take far too long on anything but the smallest parameters
+SLOW_SOLVERS = ['basic', 'bucketed', 'packed']
+
+def get_solver(name, max_pairs=None, ram_budget=None, tmp_dir=None):
+    '''Returns the named solver. If max_pairs is set, the solver prunes each
+    round, taking at most max_pairs pairs from each bucket.
+
+    ram_budget (in bytes) and tmp_dir are the memory budget of the disk
+    solver and the directory it keeps its tables in, if not the defaults.'''
+    if max_pairs is not None:
+        if name not in PRUNING_SOLVERS:
+            raise ValueError('The %s solver does not support pruning' % name)
+        if max_pairs < 1:
+            raise ValueError('Pruning must keep at least 1 pair from each bucket')
+    if ram_budget is not None or tmp_dir is not None:
+        if name != 'disk':
+            raise ValueError('Only the disk solver takes a memory budget and directory')
+        import pow_numpy
+        return partial(pow_numpy.gbp_disk, ram_budget=ram_budget or pow_numpy.RAM_BUDGET,
+                       path=tmp_dir)
+    if max_pairs is not None:
+        return partial(get_solver(name), prune=True, max_pairs=max_pairs)
+    if name == 'basic':
+        # Stream the solutions, so that mining stops at the first one that
+        # passes the difficulty filter
+        return iter_solutions
+    if name == 'bucketed':
+        return gbp_bucketed
+    if name == 'packed':
+        return gbp_packed
+    # The NumPy solvers are optional
+    import pow_numpy
+    return getattr(pow_numpy, 'gbp_' + name)
+
+def metrics_writer(path):
+    '''Returns a solver hook that appends each record it is passed to the
+    file at path, as a line of JSON. The file is unbuffered, so that the lines
+    written by parallel workers are not interleaved.'''
+    f = open(path, 'a', 0)
+    return lambda record: f.write(json.dumps(record, sort_keys=True) + '\n')
+
+def start_process(target, args=(), daemon=True):
+    '''Starts a process running target(*args), and returns it.'''
+    # Don't let the process inherit unwritten output
+    sys.stdout.flush()
+    p = multiprocessing.Process(target=target, args=args)
+    p.daemon = daemon
+    p.start()
+    return p
+
+def start_pool(workers):
+    '''Returns a multiprocessing.Pool of the given number of processes.'''
+    sys.stdout.flush()
+    return multiprocessing.Pool(workers)
+
+def table_producer(queue, digest, n, k, start, stride):
+    '''Puts the first list of each of the nonces start, start+stride, ... on
+    queue, blocking while it is full. Runs in a producer process.'''
+    nonce = start
+    while nonce >> 161 == 0:
+        curr_digest = digest.copy()
+        hash_nonce(curr_digest, nonce)
+        # A string pickles much faster than a bytearray
+        queue.put((nonce, bytes(generate_table(curr_digest, n, k))))
+        nonce += stride
+
+def pipelined_tables(digest, n, k, start=0, stride=1, depth=PIPELINE_DEPTH):
+    '''Yields (nonce, first list) for the nonces start, start+stride, ...
+    The lists are built ahead by a producer process, with at most depth of
+    them waiting, so that hashing overlaps with the rounds of the solver.
+
+    The producer is stopped when the generator is closed.'''
+    queue = multiprocessing.Queue(depth)
+    p = start_process(table_producer, (queue, digest, n, k, start, stride))
+    try:
+        while True:
+            yield queue.get()
+    finally:
+        p.terminate()
+        p.join()
+
+class Stopped(Exception):
+    '''Raised in a mining worker to interrupt its solver when it is stopped.'''
+
+def raise_stopped(signum, frame):
+    raise Stopped()
+
+def signal_stop(stop):
+    '''Waits for the Event stop, and then interrupts the main thread of this
+    process with SIGUSR1.'''
+    stop.wait()
+    os.kill(os.getpid(), signal.SIGUSR1)
+
+def find_nonce(digest, prev_hash, n, k, d, solver, start=0, stride=1, report=None,
+               hook=None, end=None, checkpoint=None, tables=None, stop=None):
+    '''Tries nonces start, start+stride, ... below end (if given) until one
+    has a solution that passes the difficulty filter, and returns
+    (nonce, solution), or (None, None) if there is none.
+
+    If given, hook is passed the solver's phase records, tagged with the
+    nonce being tried. If checkpoint is given, the nonce being tried is
+    recorded there, and passed to the solver to save its rounds. If tables is
+    given, it yields (nonce, first list) for the same nonces, as
+    pipelined_tables does, and each list is passed to the solver.
+
+    If stop is given, it is an Event that stops the search once set, and
+    (None, None) is returned. The solver is interrupted by raising Stopped
+    while it runs.'''
+    solver_args = {'checkpoint': checkpoint} if checkpoint else {}
+    nonce = start
+    while (nonce >> 161 == 0) and (end is None or nonce < end):
+        if stop and stop.is_set():
+            break
+        if DEBUG:
+            print
+            print 'Nonce: %d' % nonce
+        if checkpoint: checkpoint.start(n, k, prev_hash, nonce)
+        if tables:
+            table_nonce, solver_args['table'] = next(tables)
+            assert table_nonce == nonce, 'Tables are for other nonces'
+        # H(I||V||...
+        curr_digest = digest.copy()
+        hash_nonce(curr_digest, nonce)
+        # (x_1, x_2, ...) = A(I, V, n, k)
+        if DEBUG:
+            gbp_start = datetime.today()
+        solver_hook = None
+        if hook:
+            solver_hook = lambda record, nonce=nonce: hook(dict(record, nonce=nonce))
+        solns = 0
+        # Check each solution as the solver yields it, so that a streaming
+        # solver is stopped at the first one that passes
+        try:
+            for soln, passed in iter_difficulty(
+                    prev_hash, nonce, solver(curr_digest, n, k, hook=solver_hook, **solver_args),
+                    d):
+                solns += 1
+                if passed:
+                    if DEBUG: print 'GBP took %s' % str(datetime.today() - gbp_start)
+                    return nonce, soln
+        except Stopped:
+            break
+        if DEBUG:
+            print 'GBP took %s' % str(datetime.today() - gbp_start)
+            print 'Number of solutions: %d' % solns
+        if report: report(nonce)
+        nonce += stride
+    return None, None
+
+def mine_worker(queue, digest, prev_hash, n, k, d, solver, start, stride, hook, stop):
+    # Interrupt the solve in progress as soon as the worker is stopped
+    signal.signal(signal.SIGUSR1, raise_stopped)
+    watcher = threading.Thread(target=signal_stop, args=(stop,))
+    watcher.daemon = True
+    watcher.start()
+    report = lambda nonce: queue.put((start, nonce, None))
+    try:
+        nonce, soln = find_nonce(digest, prev_hash, n, k, d, solver, start, stride, report,
+                                 hook, stop=stop)
+        if not stop.is_set():
+            queue.put((start, nonce, soln))
+    except Stopped:
+        pass
+
+def find_nonce_parallel(digest, prev_hash, n, k, d, solver, workers, hook=None):
+    '''Parallel version of find_nonce, with each worker process trying every
+    workers-th nonce. Returns (nonce, solution, number of solves).
+
+    The result is the same as for find_nonce: once a solution has been found,
+    workers still trying lower nonces carry on, and the others are stopped.
+    They are signalled to stop rather than terminated, as they may be writing
+    to the shared queue.'''
+    queue = multiprocessing.Queue()
+    stops = [multiprocessing.Event() for w in range(workers)]
+    procs = [start_process(mine_worker, (queue, digest, prev_hash, n, k, d, solver, w,
+                                         workers, hook, stops[w]))
+             for w in range(workers)]
+
+    # The nonce each worker is currently trying, or None once it has stopped
+    current = range(workers)
+    best = (None, None)
+    solves = 0
+    while any(c is not None for c in current):
+        exited = []
+        try:
+            messages = [queue.get(timeout=1)]
+        except Empty:
+            # Workers that have exited, which are only retired once whatever
+            # they put on the queue before exiting has been read
+            exited = [w for w, p in enumerate(procs) if not p.is_alive()]
+            messages = []
+            try:
+                while True:
+                    messages.append(queue.get_nowait())
+            except Empty:
+                pass
+        for w, nonce, soln in messages:
+            if current[w] is None:
+                # A stopped worker reporting the nonce it was on
+                continue
+            solves += 1
+            if soln is None:
+                current[w] = nonce + workers
+            else:
+                current[w] = None
+                if best[0] is None or nonce < best[0]:
+                    best = (nonce, soln)
+            if best[0] is not None:
+                for v in range(workers):
+                    if current[v] is not None and current[v] > best[0]:
+                        stops[v].set()
+                        current[v] = None
+        for w in exited:
+            current[w] = None
+    for p in procs:
+        p.join()
+    return best + (solves,)
+
+def mine(n, k, d, solver=None, workers=None, metrics=None, max_pairs=None, cache=None,
+         checkpoint=None, pipeline=None, profile=None, ram_budget=None, tmp_dir=None):
+    '''Mines blocks forever, with the options of the command-line flags of the
+    same names. Unless given, the solver, workers and pipeline are tuned.'''
+    tuned = None
+    if (solver, workers, pipeline, max_pairs, checkpoint) == (None,)*5:
+        from autotune import load_tuned
+        tuned = load_tuned(n, k, profile)
+        if tuned:
+            solver, workers, pipeline = tuned['solver'], tuned['workers'], tuned['pipeline']
+    solver = solver or 'basic'
+    workers = workers or 1
+    if checkpoint and (workers > 1 or solver not in CHECKPOINT_SOLVERS):
+        raise ValueError('Checkpoints need a single worker and one of the %s solvers' %
+                         ' or '.join(CHECKPOINT_SOLVERS))
+    if pipeline and workers > 1:
+        raise ValueError('The pipelined miner uses a single worker')
+    if solver in POOL_SOLVERS and workers > 1:
+        raise ValueError('The %s solver runs its own workers, so needs a single miner '
+                         'worker' % solver)
+    if (ram_budget is not None or tmp_dir is not None) and solver != 'disk':
+        raise ValueError('A memory budget and directory are only for the disk solver, '
+                         'not %s' % solver)
     print 'Miner starting'
-    validate_params(n, k)
+    params = equihash_params(n, k)
     print '- n: %d' % n
     print '- k: %d' % k
     print '- d: %d' % d
+    print '- solver: %s' % solver
+    print '- workers: %d' % workers
+    if tuned:
+        print '- tuned: %.2f solves/sec in probes' % tuned['solves_per_sec']
+    print '- hashes: %s' % backend_name()
+    if max_pairs is not None:
+        print '- pruning: %d pairs per bucket' % max_pairs
+    if pipeline:
+        print '- pipeline: %d lists ahead' % pipeline
+    if ram_budget is not None:
+        print '- RAM budget: %d MiB' % (ram_budget >> 20)
+    if tmp_dir is not None:
+        print '- tables in: %s' % tmp_dir
+    name = solver
+    solver = get_solver(solver, max_pairs, ram_budget, tmp_dir)
+    if cache:
+        from cache import SolutionCache
+        if max_pairs is not None:
+            name += ' pruned to %d' % max_pairs
+        solver = SolutionCache(cache).wrap(solver, name)
+    hook = metrics_writer(metrics) if metrics else None
     # Genesis
-    digest = hashes.Hash(hashes.SHA256(), backend=default_backend())
-    prev_hash = digest.finalize()
+    prev_hash = sha256().digest()
+    start_nonce = 0
+    if checkpoint:
+        from checkpoint import Checkpoint
+        checkpoint = Checkpoint(checkpoint)
+        resumed = checkpoint.resume(n, k)
+        if resumed:
+            prev_hash, start_nonce = resumed
+            print '- resuming: nonce %d of the block after %s' % (
+                start_nonce, print_hash(prev_hash))
     while True:
         start = datetime.today()
         # H(I||...
-        digest = blake2b(digest_size=(512/n)*n/8, person=zcash_person(n, k))
-        digest.update(prev_hash)
-        nonce = 0
-        x = None
-        while (nonce >> 161 == 0):
-            if DEBUG:
-                print
-                print 'Nonce: %d' % nonce
-            # H(I||V||...
-            curr_digest = digest.copy()
-            hash_nonce(curr_digest, nonce)
-            # (x_1, x_2, ...) = A(I, V, n, k)
-            if DEBUG:
-                gbp_start = datetime.today()
-            solns = gbp_basic(curr_digest, n, k)
-            if DEBUG:
-                print 'GBP took %s' % str(datetime.today() - gbp_start)
-                print 'Number of solutions: %d' % len(solns)
-            for soln in solns:
-                if difficulty_filter(prev_hash, nonce, soln, d):
-                    x = soln
-                    break
-            if x:
-                break
-            nonce += 1
+        digest = params.header_digest(prev_hash)
+        if workers > 1:
+            nonce, x, solves = find_nonce_parallel(digest, prev_hash, n, k, d,
+                                                   solver, workers, hook)
+        else:
+            tables = None
+            if pipeline:
+                tables = pipelined_tables(digest, n, k, start_nonce, depth=pipeline)
+            try:
+                nonce, x = find_nonce(digest, prev_hash, n, k, d, solver, start_nonce,
+                                      hook=hook, checkpoint=checkpoint, tables=tables)
+            finally:
+                if tables: tables.close()
+            solves = nonce + 1 - start_nonce if x else 0
         duration = datetime.today() - start
 
         if not x:
             raise RuntimeError('Could not find any valid nonce. Wow.')
 
-        curr_hash = block_hash(prev_hash, nonce, soln)
+        curr_hash = block_hash(prev_hash, nonce, x)
         print '-----------------'
         print 'Mined block!'
         print 'Previous hash: %s' % print_hash(prev_hash)
         print 'Current hash:  %s' % print_hash(curr_hash)
         print 'Nonce:         %s' % nonce
         print 'Time to find:  %s' % str(duration)
+        print 'Solves/sec:    %.2f' % (solves / duration.total_seconds())
         print '-----------------'
         prev_hash = curr_hash
+        start_nonce = 0
 
 
 if __name__ == '__main__':
@@ -258,9 +990,56 @@ if __name__ == '__main__':
                         help='number of strings needed for a solution')
     parser.add_argument('-d', type=int, default=3,
                         help='the difficulty (higher is more difficult)')
+    parser.add_argument('-s', '--solver', choices=SOLVERS,
+                        help='the solver to use (all but %s require NumPy; default: '
+                             'the tuned one, or basic)' % ', '.join(SLOW_SOLVERS))
+    parser.add_argument('-w', '--workers', type=int,
+                        help='number of processes to mine with in parallel (default: '
+                             'the tuned number, or 1)')
+    parser.add_argument('-p', '--prune', type=int, nargs='?', const=PRUNE_MAX_PAIRS,
+                        metavar='MAX_PAIRS',
+                        help='drop zero entries and take at most MAX_PAIRS pairs '
+                             'from each bucket (default: %d); only for %s' % (
+                                 PRUNE_MAX_PAIRS, ' and '.join(PRUNING_SOLVERS)))
+    parser.add_argument('-c', '--cache', metavar='DIR',
+                        help='cache solutions in DIR')
+    parser.add_argument('--pipeline', type=int, nargs='?', const=PIPELINE_DEPTH,
+                        metavar='DEPTH',
+                        help='build the first list of the next nonces in a separate '
+                             'process, at most DEPTH ahead (default: %d); only with one '
+                             'worker' % PIPELINE_DEPTH)
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='save progress to FILE, and resume from it; only with '
+                             'one worker and the %s solvers' % ' or '.join(CHECKPOINT_SOLVERS))
+    parser.add_argument('--ram-budget', type=int, metavar='MIB',
+                        help='memory budget of the disk solver, in MiB (default: 256)')
+    parser.add_argument('--tmp-dir', metavar='DIR',
+                        help='keep the tables of the disk solver under DIR (default: '
+                             'the system temporary directory, often in RAM)')
+    parser.add_argument('-m', '--metrics', metavar='FILE',
+                        help='append per-round solver metrics to FILE as JSON lines')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='read the configuration tuned by autotune.py from FILE')
     parser.add_argument('-v', '--verbosity', action='count',
                         help='show debug output (use -vv for verbose output)')
     args = parser.parse_args()
+    # Pruning and checkpoints are not tuned, so they default to the basic solver
+    solver = args.solver or 'basic'
+    if args.prune is not None and solver not in PRUNING_SOLVERS:
+        parser.error('the %s solver does not support pruning' % solver)
+    if args.prune is not None and args.prune < 1:
+        parser.error('--prune needs at least 1 pair per bucket')
+    if args.checkpoint and (args.workers > 1 or solver not in CHECKPOINT_SOLVERS):
+        parser.error('--checkpoint needs a single worker and the %s solvers' %
+                     ' or '.join(CHECKPOINT_SOLVERS))
+    if args.pipeline is not None and (args.pipeline < 1 or args.workers > 1):
+        parser.error('--pipeline needs a single worker and a depth of at least 1')
+    if args.solver in POOL_SOLVERS and args.workers > 1:
+        parser.error('the %s solver runs its own workers, so needs a single miner worker' %
+                     args.solver)
+    # Without a solver, the tuned one is checked once the profile is read
+    if (args.ram_budget is not None or args.tmp_dir) and args.solver not in (None, 'disk'):
+        parser.error('--ram-budget and --tmp-dir are only for the disk solver')
 
     DEBUG = args.verbosity > 0
     VERBOSE = args.verbosity > 1
@@ -274,6 +1053,8 @@ if __name__ == '__main__':
             print
 
     try:
-        mine(args.n, args.k, args.d)
+        mine(args.n, args.k, args.d, args.solver, args.workers, args.metrics, args.prune,
+             args.cache, args.checkpoint, args.pipeline, args.profile,
+             args.ram_budget << 20 if args.ram_budget is not None else None, args.tmp_dir)
     except KeyboardInterrupt:
         pass
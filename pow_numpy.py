@@ -0,0 +1,467 @@
+#!/usr/bin/env python2
+import multiprocessing
+import numpy as np
+import os
+import shutil
+import tempfile
+import time
+
+from pow import (
+    add_round_stats,
+    equihash_params,
+    generate_table,
+    iter_table,
+    phase_record,
+    round_stats,
+    start_pool,
+)
+
+# Number of key ranges each round is split into per gbp_sharded worker
+SHARDS_PER_WORKER = 4
+
+# Where gbp_sharded keeps the tables shared with its workers
+SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+# Default memory budget of gbp_disk, in bytes
+RAM_BUDGET = 256 << 20
+
+# Rough number of bytes of memory gbp_disk uses per byte of a partition
+PARTITION_OVERHEAD = 8
+
+
+def table_columns(table, n, k):
+    '''Converts a buffer of expanded hashes to one uint32 column per
+    collision chunk.'''
+    collision_bytes = (n/(k+1)+7)/8
+    table = np.frombuffer(table, dtype=np.uint8).reshape(-1, k+1, collision_bytes)
+    # The expanded chunks are big-endian
+    X = np.zeros(table.shape[:2], dtype=np.uint32)
+    for j in range(collision_bytes):
+        X = (X << 8) | table[:, :, j]
+    return X
+
+def generate_list(digest, n, k, table=None):
+    '''Returns the first list, as one uint32 column per collision chunk. If
+    given, table is the output of generate_table for digest, built ahead of
+    time.'''
+    if table is None:
+        table = generate_table(digest, n, k)
+    return table_columns(table, n, k)
+
+def add_buckets(stats, key):
+    '''Adds the sizes of the runs of equal values in the sorted array key to
+    the bucket histogram in stats.'''
+    if len(key) == 0:
+        return
+    ends = np.append(np.flatnonzero(key[1:] != key[:-1]) + 1, len(key))
+    counts = np.bincount(np.diff(np.append(0, ends)))
+    for size in np.flatnonzero(counts):
+        stats['buckets'][int(size)] = stats['buckets'].get(int(size), 0) + int(counts[size])
+
+def collision_pairs(key, stats=None):
+    '''Returns all unordered pairs (a, b) of rows sharing the same key.
+
+    If given, the bucket sizes and the number of pairs are added to stats.'''
+    order = np.argsort(key)
+    key = key[order]
+    if stats is not None:
+        add_buckets(stats, key)
+    a = []
+    b = []
+    # The list is sorted, so rows p and p+d collide only if every row between
+    # them does too; stop at the first distance with no collisions.
+    d = 1
+    while d < len(key):
+        p = np.flatnonzero(key[:-d] == key[d:])
+        if len(p) == 0:
+            break
+        a.append(order[p])
+        b.append(order[p+d])
+        d += 1
+    if stats is not None:
+        stats['pairs'] += sum(len(p) for p in a)
+    if not a:
+        return np.zeros(0, dtype=order.dtype), np.zeros(0, dtype=order.dtype)
+    return np.concatenate(a), np.concatenate(b)
+
+def join_indices(ia, ib):
+    '''Concatenates the index rows of each pair, lowest first index first,
+    and returns them along with a mask of the pairs with distinct indices.'''
+    swap = (ia[:, 0] > ib[:, 0])[:, np.newaxis]
+    concat = np.concatenate([np.where(swap, ib, ia), np.where(swap, ia, ib)], axis=1)
+    s = np.sort(concat, axis=1)
+    distinct = ~(s[:, 1:] == s[:, :-1]).any(axis=1)
+    return concat, distinct
+
+def distinct_children(pointers, a, b):
+    '''Returns a mask of the pairs (a, b) of entries that were not built from
+    a common entry of the previous round.'''
+    pa = pointers[a]
+    pb = pointers[b]
+    return ((pa[:, 0] != pb[:, 0]) & (pa[:, 0] != pb[:, 1]) &
+            (pa[:, 1] != pb[:, 0]) & (pa[:, 1] != pb[:, 1]))
+
+def leaf_indices(tree, pairs):
+    '''Walks pairs of entries in the last round of the tree of pointers back
+    down to the first list, and returns the indices they were built from.'''
+    I = pairs
+    for pointers in reversed(tree):
+        I = pointers[I].reshape(len(I), 2*I.shape[1])
+    return I
+
+def has_duplicates(I):
+    s = np.sort(I, axis=1)
+    return (s[:, 1:] == s[:, :-1]).any(axis=1)
+
+def drop_zero_duplicates(tree, X, pairs):
+    '''Drops the entries whose hash has been XORed away completely by using
+    an index twice. These entries all collide with each other, so keeping them
+    would blow up the size of the following rounds.'''
+    zero = np.flatnonzero(~X.any(axis=1))
+    if len(zero) == 0:
+        return X, pairs
+    keep = np.ones(len(X), dtype=bool)
+    keep[zero[has_duplicates(leaf_indices(tree, pairs[zero]))]] = False
+    return X[keep], pairs[keep]
+
+def rebuild_indices(tree, pairs):
+    '''Rebuilds the indices of pairs of final-round entries, and returns the
+    distinct-index solutions in canonical order.'''
+    # Indexing read-only memory maps returns read-only arrays
+    I = np.array(leaf_indices(tree, pairs))
+
+    # Order each pair of subtrees by their first index, from the leaves up
+    w = 1
+    while w < I.shape[1]:
+        v = I.reshape(len(I), I.shape[1]/(2*w), 2, w)
+        swap = v[:, :, 0, 0] > v[:, :, 1, 0]
+        v[swap] = v[swap][:, ::-1]
+        w *= 2
+
+    # Reject solutions with duplicate indices
+    return I[~has_duplicates(I)]
+
+def gbp_numpy(digest, n, k, hook=None, table=None):
+    '''Implementation of Basic Wagner's algorithm for the GBP, using NumPy.
+
+    Hashes are stored as one uint32 column per collision chunk, and indices as
+    a uint32 array with one row per entry. Each round drops the column it has
+    collided on.'''
+    params = equihash_params(n, k)
+    collision_length = params.collision_length
+    list_length = params.list_length
+
+    # 1) Generate first list
+    start = time.time()
+    X = generate_list(digest, n, k, table)
+    I = np.arange(list_length, dtype=np.uint32).reshape(-1, 1)
+    if hook: hook(phase_record('list', start, {'size': len(X)}))
+
+    # 3) Repeat step 2 until 2n/(k+1) bits remain
+    for i in range(1, k):
+        start = time.time()
+        stats = round_stats(len(X)) if hook else None
+        # 2a-b) Find all unordered pairs with collisions on the next n/(k+1) bits
+        a, b = collision_pairs(X[:, 0], stats)
+
+        # 2c) Store tuples (X_i ^ X_j, (i, j)) on the table
+        I, distinct = join_indices(I[a], I[b])
+        # 2e) Replace previous list with new list
+        X = (X[a, 1:] ^ X[b, 1:])[distinct]
+        I = I[distinct]
+        if hook:
+            stats['dropped'] = len(a) - len(X)
+            hook(phase_record('round %d' % i, start, stats))
+
+    # k+1) Find a collision on last 2n(k+1) bits
+    start = time.time()
+    stats = round_stats(len(X)) if hook else None
+    key = (X[:, 0].astype(np.uint64) << collision_length) | X[:, 1]
+    a, b = collision_pairs(key, stats)
+    I, distinct = join_indices(I[a], I[b])
+    solns = I[distinct].tolist()
+    if hook:
+        stats['dropped'] = len(a) - len(solns)
+        hook(phase_record('final', start, stats))
+    return solns
+
+def gbp_tree(digest, n, k, hook=None, table=None):
+    '''Implementation of Basic Wagner's algorithm for the GBP, using NumPy.
+
+    Instead of carrying the indices along with each entry, every round stores
+    a table of pointers to the pair of entries in the previous round that it
+    was built from. Indices are only rebuilt for final-round collisions.'''
+    collision_length = equihash_params(n, k).collision_length
+
+    # 1) Generate first list
+    start = time.time()
+    X = generate_list(digest, n, k, table)
+    tree = []
+    if hook: hook(phase_record('list', start, {'size': len(X)}))
+
+    # 3) Repeat step 2 until 2n/(k+1) bits remain
+    for i in range(1, k):
+        start = time.time()
+        stats = round_stats(len(X)) if hook else None
+        # 2a-b) Find all unordered pairs with collisions on the next n/(k+1) bits
+        a, b = collision_pairs(X[:, 0], stats)
+        if tree:
+            # Entries built from the same entry share indices
+            distinct = distinct_children(tree[-1], a, b)
+            a = a[distinct]
+            b = b[distinct]
+
+        # 2c) Store tuples (X_i ^ X_j, (i, j)) on the table
+        pairs = np.column_stack([a, b]).astype(np.uint32)
+        X, pairs = drop_zero_duplicates(tree, X[a, 1:] ^ X[b, 1:], pairs)
+        # 2e) Replace previous list with new list
+        tree.append(pairs)
+        if hook:
+            stats['dropped'] = stats['pairs'] - len(X)
+            hook(phase_record('round %d' % i, start, stats))
+
+    # k+1) Find a collision on last 2n(k+1) bits
+    start = time.time()
+    stats = round_stats(len(X)) if hook else None
+    key = (X[:, 0].astype(np.uint64) << collision_length) | X[:, 1]
+    a, b = collision_pairs(key, stats)
+    if tree:
+        distinct = distinct_children(tree[-1], a, b)
+        a = a[distinct]
+        b = b[distinct]
+    solns = rebuild_indices(tree, np.column_stack([a, b]).astype(np.uint32)).tolist()
+    if hook:
+        stats['dropped'] = stats['pairs'] - len(solns)
+        hook(phase_record('final', start, stats))
+    return solns
+
+def collide_rows(tree, X, rows, i, k, collision_length, stats=None):
+    '''Finds the collisions in round i between the entries X, which are the
+    given rows of the previous round's table.
+
+    Returns the new entries and their pointers, or only the pointers in the
+    final round. If given, the round statistics of these entries are added to
+    stats.'''
+    if i < k:
+        a, b = collision_pairs(X[:, 0], stats)
+    else:
+        a, b = collision_pairs((X[:, 0].astype(np.uint64) << collision_length) | X[:, 1],
+                               stats)
+    found = len(a)
+    if tree:
+        distinct = distinct_children(tree[-1], rows[a], rows[b])
+        a = a[distinct]
+        b = b[distinct]
+    pairs = np.column_stack([rows[a], rows[b]]).astype(np.uint32)
+    if i < k:
+        out = drop_zero_duplicates(tree, X[a, 1:] ^ X[b, 1:], pairs)
+        pairs = out[1]
+    else:
+        out = pairs
+    if stats is not None:
+        stats['dropped'] += found - len(pairs)
+    return out
+
+def collide_shard(args):
+    '''Finds the collisions in round i of gbp_sharded between the entries with
+    keys in [lo, hi), and writes them to a new shard of the table.
+
+    Returns the number of entries in the shard, or the final-round pairs,
+    along with the shard's round statistics if requested.'''
+    path, i, k, collision_length, lo, hi, with_stats = args
+    X = np.load(os.path.join(path, 'X%d.npy' % (i-1)), mmap_mode='r')
+    tree = [np.load(os.path.join(path, 'P%d.npy' % r), mmap_mode='r')
+            for r in range(1, i)]
+
+    rows = np.flatnonzero((X[:, 0] >= lo) & (X[:, 0] < hi))
+    stats = round_stats(len(rows)) if with_stats else None
+    out = collide_rows(tree, X[rows], rows, i, k, collision_length, stats)
+    if i == k:
+        return out, stats
+
+    X, pairs = out
+    np.save(os.path.join(path, 'X%d-%d.npy' % (i, lo)), X)
+    np.save(os.path.join(path, 'P%d-%d.npy' % (i, lo)), pairs)
+    return len(X), stats
+
+def join_shards(path, name, shards):
+    '''Concatenates the shards of a table into a single file.'''
+    parts = [np.load(os.path.join(path, '%s-%d.npy' % (name, lo)), mmap_mode='r')
+             for lo in shards]
+    out = np.lib.format.open_memmap(
+        os.path.join(path, '%s.npy' % name), mode='w+', dtype=parts[0].dtype,
+        shape=(sum(len(p) for p in parts),) + parts[0].shape[1:])
+    start = 0
+    for lo, p in zip(shards, parts):
+        out[start:start+len(p)] = p
+        start += len(p)
+        os.remove(os.path.join(path, '%s-%d.npy' % (name, lo)))
+    out.flush()
+
+def gbp_sharded(digest, n, k, workers=None, hook=None, table=None):
+    '''Implementation of Basic Wagner's algorithm for the GBP, as gbp_tree,
+    with each round split across a pool of worker processes.
+
+    Each worker finds the collisions for a range of values of the next
+    n/(k+1) bits. The tables are passed between rounds as memory-mapped files
+    in SHARED_DIR, rather than being pickled.'''
+    params = equihash_params(n, k)
+    collision_length = params.collision_length
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    num_shards = SHARDS_PER_WORKER*workers
+    step = -(-2**collision_length // num_shards)
+    shards = range(0, 2**collision_length, step)
+
+    path = tempfile.mkdtemp(prefix='gbp-', dir=SHARED_DIR)
+    pool = start_pool(workers)
+    try:
+        # 1) Generate first list
+        start = time.time()
+        np.save(os.path.join(path, 'X0.npy'), generate_list(digest, n, k, table))
+        rows = params.list_length
+        if hook: hook(phase_record('list', start, {'size': rows}))
+
+        # 3) Repeat step 2 until 2n/(k+1) bits remain
+        for i in range(1, k):
+            start = time.time()
+            # 2a-c) Find the collisions on the next n/(k+1) bits, shard by shard
+            results = pool.map(collide_shard, [
+                (path, i, k, collision_length, lo, lo+step, bool(hook)) for lo in shards])
+            # 2e) Replace previous list with new list
+            join_shards(path, 'X%d' % i, shards)
+            join_shards(path, 'P%d' % i, shards)
+            os.remove(os.path.join(path, 'X%d.npy' % (i-1)))
+            if hook:
+                stats = round_stats(rows)
+                for _, shard_stats in results:
+                    add_round_stats(stats, shard_stats)
+                hook(phase_record('round %d' % i, start, stats))
+            rows = sum(r for r, _ in results)
+
+        # k+1) Find a collision on last 2n(k+1) bits
+        start = time.time()
+        results = pool.map(collide_shard, [
+            (path, k, k, collision_length, lo, lo+step, bool(hook)) for lo in shards])
+        pairs = np.concatenate([p for p, _ in results])
+        tree = [np.load(os.path.join(path, 'P%d.npy' % r), mmap_mode='r')
+                for r in range(1, k)]
+        solns = rebuild_indices(tree, pairs).tolist()
+        if hook:
+            stats = round_stats(rows)
+            for _, shard_stats in results:
+                add_round_stats(stats, shard_stats)
+            stats['dropped'] += len(pairs) - len(solns)
+            hook(phase_record('final', start, stats))
+        return solns
+    finally:
+        pool.terminate()
+        shutil.rmtree(path)
+
+def append_rows(path, rows):
+    with open(path, 'ab') as f:
+        rows.tofile(f)
+
+def load_rows(path, cols):
+    '''Memory-maps a file of fixed-width records of cols uint32 values.'''
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return np.zeros((0, cols), dtype=np.uint32)
+    return np.memmap(path, dtype=np.uint32, mode='r').reshape(-1, cols)
+
+def partition_rows(path, name, cols, collision_length, part_bits, ram_budget):
+    '''Splits the table name.bin into 2^part_bits files name-p.bin, on the
+    leading bits of the first column. The row number of each entry within the
+    table is appended to it.'''
+    X = load_rows(os.path.join(path, name + '.bin'), cols)
+    chunk_rows = max(1, ram_budget/(PARTITION_OVERHEAD*4*(cols+1)))
+    for start in xrange(0, len(X), chunk_rows):
+        end = min(start+chunk_rows, len(X))
+        chunk = np.column_stack([X[start:end],
+                                 np.arange(start, end, dtype=np.uint32)])
+        part = chunk[:, 0] >> (collision_length - part_bits)
+        order = np.argsort(part)
+        bounds = np.searchsorted(part[order], np.arange(2**part_bits+1))
+        for p in np.flatnonzero(bounds[1:] > bounds[:-1]):
+            append_rows(os.path.join(path, '%s-%d.bin' % (name, p)),
+                        chunk[order[bounds[p]:bounds[p+1]]])
+
+def disk_round(path, i, k, collision_length, rows, ram_budget, stats=None):
+    '''Runs round i of gbp_disk on the table X{i-1}.bin of the given number
+    of rows, one partition at a time.
+
+    Returns the number of rows in X{i}.bin, or the final-round pairs. If
+    given, the round statistics are added to stats.'''
+    cols = k+2-i
+    tree = [load_rows(os.path.join(path, 'P%d.bin' % r), 2) for r in range(1, i)]
+
+    # Split the table into partitions that each fit in the memory budget
+    part_bits = 0
+    while (part_bits < collision_length and
+           (rows*4*(cols+1)*PARTITION_OVERHEAD >> part_bits) > ram_budget):
+        part_bits += 1
+    if stats is not None:
+        stats['partitions'] = 2**part_bits
+    partition_rows(path, 'X%d' % (i-1), cols, collision_length, part_bits, ram_budget)
+    # No table is written for a round without any collisions
+    if os.path.exists(os.path.join(path, 'X%d.bin' % (i-1))):
+        os.remove(os.path.join(path, 'X%d.bin' % (i-1)))
+
+    pairs = []
+    rows = 0
+    for p in range(2**part_bits):
+        part_path = os.path.join(path, 'X%d-%d.bin' % (i-1, p))
+        if not os.path.exists(part_path):
+            continue
+        part = np.fromfile(part_path, dtype=np.uint32).reshape(-1, cols+1)
+        os.remove(part_path)
+        out = collide_rows(tree, part[:, :-1], part[:, -1], i, k, collision_length,
+                           stats)
+        if i == k:
+            pairs.append(out)
+        else:
+            append_rows(os.path.join(path, 'X%d.bin' % i), out[0])
+            append_rows(os.path.join(path, 'P%d.bin' % i), out[1])
+            rows += len(out[0])
+    if i == k:
+        return np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.uint32)
+    return rows
+
+def gbp_disk(digest, n, k, ram_budget=RAM_BUDGET, path=None, hook=None, table=None):
+    '''Implementation of Basic Wagner's algorithm for the GBP, as gbp_tree,
+    with the tables kept in memory-mapped files of fixed-width records in a
+    temporary directory under path.
+
+    Each round splits the table into partitions on the leading bits of the
+    next n/(k+1) bits, small enough to process within ram_budget bytes of
+    memory, and then finds the collisions one partition at a time. The
+    records passed to hook hold the number of partitions of each round.'''
+    params = equihash_params(n, k)
+    collision_length = params.collision_length
+    path = tempfile.mkdtemp(prefix='gbp-', dir=path)
+    try:
+        # 1) Generate first list
+        start = time.time()
+        for batch in iter_table(digest, n, k) if table is None else [table]:
+            append_rows(os.path.join(path, 'X0.bin'), table_columns(batch, n, k))
+        rows = params.list_length
+        if hook: hook(phase_record('list', start, {'size': rows}))
+
+        # 3) Repeat step 2 until 2n/(k+1) bits remain
+        for i in range(1, k):
+            start = time.time()
+            stats = round_stats(rows) if hook else None
+            rows = disk_round(path, i, k, collision_length, rows, ram_budget, stats)
+            if hook: hook(phase_record('round %d' % i, start, stats))
+
+        # k+1) Find a collision on last 2n(k+1) bits
+        start = time.time()
+        stats = round_stats(rows) if hook else None
+        pairs = disk_round(path, k, k, collision_length, rows, ram_budget, stats)
+        tree = [load_rows(os.path.join(path, 'P%d.bin' % r), 2) for r in range(1, k)]
+        solns = rebuild_indices(tree, pairs).tolist()
+        if hook:
+            stats['dropped'] += len(pairs) - len(solns)
+            hook(phase_record('final', start, stats))
+        return solns
+    finally:
+        shutil.rmtree(path)
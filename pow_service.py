@@ -0,0 +1,303 @@
+#!/usr/bin/env python2
+import argparse
+from binascii import hexlify, unhexlify
+from collections import deque
+import json
+import multiprocessing
+import os
+import socket
+import SocketServer
+import stat
+import sys
+import threading
+
+from pow import (
+    POOL_SOLVERS,
+    SOLVERS,
+    block_hash,
+    equihash_params,
+    find_nonce,
+    get_solver,
+    start_process,
+)
+
+
+def solve_job(job, conn):
+    '''Searches the nonce range of a job for a solution that passes the
+    difficulty filter, and sends (nonce, solution, error) through conn.
+    Runs in a worker process.'''
+    try:
+        n, k = job['n'], job['k']
+        digest = equihash_params(n, k).header_digest(job['header'])
+        nonce, soln = find_nonce(digest, job['header'], n, k, job['d'],
+                                 get_solver(job['solver']), job['start'],
+                                 end=job['end'])
+        conn.send((nonce, soln, None))
+    except Exception as e:
+        conn.send((None, None, '%s: %s' % (type(e).__name__, e)))
+
+def result_message(job, nonce, soln, error):
+    if error is not None:
+        return {'job': job['id'], 'status': 'error', 'error': error}
+    if soln is None:
+        return {'job': job['id'], 'status': 'exhausted'}
+    return {
+        'job': job['id'],
+        'status': 'found',
+        'nonce': nonce,
+        'solution': soln,
+        'hash': hexlify(block_hash(job['header'], nonce, soln)),
+    }
+
+class JobQueue(object):
+    '''Runs jobs in the order they were submitted, each in its own worker
+    process with at most workers of them at once.
+
+    Each job is submitted with an owner and a callback, which is passed the
+    message reporting the job's result. Cancelling a job that is running
+    terminates its worker process. Each worker sends its result through its
+    own pipe, so terminating one cannot corrupt the results of the others.'''
+    def __init__(self, workers):
+        self.workers = workers
+        self.cond = threading.Condition()
+        self.pending = deque()
+        # Job id -> (job, owner, callback, worker process)
+        self.running = {}
+        self.next_id = 0
+        self.closed = False
+        t = threading.Thread(target=self.dispatch)
+        t.daemon = True
+        t.start()
+
+    def submit(self, job, owner, callback):
+        '''Queues a job, and returns its id.'''
+        with self.cond:
+            job = dict(job, id=self.next_id)
+            self.next_id += 1
+            self.pending.append((job, owner, callback))
+            self.cond.notify_all()
+        return job['id']
+
+    def cancel(self, owner, job_id=None):
+        '''Cancels the given job, or every job, of owner. Returns the ids of
+        the jobs cancelled.'''
+        cancelled = []
+        with self.cond:
+            for entry in list(self.pending):
+                job = entry[0]
+                if entry[1] is owner and job_id in (None, job['id']):
+                    self.pending.remove(entry)
+                    cancelled.append(job['id'])
+            for i, (job, o, _, p) in self.running.items():
+                if o is owner and job_id in (None, i):
+                    p.terminate()
+                    del self.running[i]
+                    cancelled.append(i)
+            self.cond.notify_all()
+        return sorted(cancelled)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.pending.clear()
+            for _, _, _, p in self.running.values():
+                p.terminate()
+            self.running.clear()
+            self.cond.notify_all()
+
+    def dispatch(self):
+        while True:
+            with self.cond:
+                while not self.closed and (not self.pending or
+                                           len(self.running) >= self.workers):
+                    self.cond.wait()
+                if self.closed:
+                    return
+                job, owner, callback = self.pending.popleft()
+                conn, child = multiprocessing.Pipe(False)
+                p = start_process(solve_job, (job, child))
+                child.close()
+                self.running[job['id']] = (job, owner, callback, p)
+                t = threading.Thread(target=self.collect, args=(job['id'], conn, p))
+                t.daemon = True
+                t.start()
+
+    def collect(self, job_id, conn, p):
+        '''Waits for the result of a job from its worker process.'''
+        try:
+            result = conn.recv()
+        except EOFError:
+            # The worker died, or was cancelled, without sending a result
+            result = None
+        finally:
+            conn.close()
+        p.join()
+        with self.cond:
+            entry = self.running.pop(job_id, None)
+            self.cond.notify_all()
+        # Results of cancelled jobs are dropped
+        if entry:
+            job, _, callback, _ = entry
+            if result is None:
+                callback(result_message(job, None, None,
+                                        'worker exited with code %d' % p.exitcode))
+            else:
+                callback(result_message(job, *result))
+
+def parse_job(request):
+    '''Validates a submit request, and returns the job it describes.'''
+    try:
+        header = unhexlify(request['header'])
+    except KeyError:
+        raise ValueError('missing field header')
+    except TypeError:
+        raise ValueError('header is not hexadecimal')
+    try:
+        job = {
+            'header': header,
+            'n': int(request['n']),
+            'k': int(request['k']),
+            'd': int(request.get('d', 0)),
+            'start': int(request.get('start', 0)),
+            'end': int(request['end']) if request.get('end') is not None else None,
+            'solver': request.get('solver', 'basic'),
+        }
+    except KeyError as e:
+        raise ValueError('missing field %s' % e)
+    except TypeError as e:
+        raise ValueError(str(e))
+    if job['n'] < 1 or job['k'] < 1:
+        raise ValueError('n and k must be positive')
+    equihash_params(job['n'], job['k'])
+    if job['solver'] not in SOLVERS:
+        raise ValueError('unknown solver %s' % job['solver'])
+    if job['solver'] in POOL_SOLVERS:
+        raise ValueError('the %s solver cannot run in a job\'s worker' % job['solver'])
+    return job
+
+class MiningHandler(SocketServer.StreamRequestHandler):
+    '''Serves one client connection. Each line received is a JSON request:
+
+    - {"method": "submit", "header": hex, "n": n, "k": k, "d": d,
+       "start": nonce, "end": nonce, "solver": name, "clean": bool} queues
+      a job to search nonces start (default 0) up to end (default unbounded)
+      for a solution to H(header||nonce||...) passing difficulty d (default
+      0), and replies {"job": id, "status": "queued"}. If clean is set, the
+      client's other jobs are cancelled first.
+    - {"method": "cancel", "job": id} cancels a job, or all of the client's
+      jobs if no id is given, and replies {"cancelled": [ids]}.
+
+    Replies echo the request's "id", if any. Each job's result is then sent
+    as a {"job": id, "status": "found", "nonce", "solution", "hash"},
+    {"job": id, "status": "exhausted"} or {"job": id, "status": "error"}
+    message, and cancelled jobs as {"job": id, "status": "cancelled"}.'''
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def finish(self):
+        # Jobs may still report their results after the connection is closed
+        with self.lock:
+            self.closed = True
+            SocketServer.StreamRequestHandler.finish(self)
+
+    def send(self, message):
+        try:
+            with self.lock:
+                if self.closed:
+                    return
+                self.wfile.write(json.dumps(message) + '\n')
+                self.wfile.flush()
+        except socket.error:
+            # The client has gone away
+            pass
+
+    def handle(self):
+        jobs = self.server.jobs
+        try:
+            for line in iter(self.rfile.readline, ''):
+                if line.strip():
+                    self.send(self.respond(line))
+        finally:
+            jobs.cancel(self)
+
+    def respond(self, line):
+        jobs = self.server.jobs
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict):
+                raise ValueError('request is not an object')
+        except ValueError as e:
+            return {'error': str(e)}
+        reply = {'id': request['id']} if 'id' in request else {}
+        method = request.get('method')
+        try:
+            if method == 'submit':
+                job = parse_job(request)
+                if request.get('clean'):
+                    for i in jobs.cancel(self):
+                        self.send({'job': i, 'status': 'cancelled'})
+                reply.update(job=jobs.submit(job, self, self.send), status='queued')
+            elif method == 'cancel':
+                cancelled = jobs.cancel(self, request.get('job'))
+                for i in cancelled:
+                    self.send({'job': i, 'status': 'cancelled'})
+                reply['cancelled'] = cancelled
+            else:
+                raise ValueError('unknown method %s' % method)
+        except ValueError as e:
+            reply['error'] = str(e)
+        return reply
+
+class MiningServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, workers):
+        SocketServer.TCPServer.__init__(self, address, MiningHandler)
+        self.jobs = JobQueue(workers)
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        self.jobs.close()
+
+class UnixMiningServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, workers):
+        # Replace the socket of a server that did not shut down cleanly
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+        SocketServer.UnixStreamServer.__init__(self, path, MiningHandler)
+        self.jobs = JobQueue(workers)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        self.jobs.close()
+        os.remove(self.server_address)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve Equihash mining jobs')
+    parser.add_argument('-l', '--listen', default='127.0.0.1:8233',
+                        help='host:port to listen on (default: %(default)s)')
+    parser.add_argument('-u', '--unix', metavar='PATH',
+                        help='listen on a Unix socket at PATH instead')
+    parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of jobs to run at once (default: one per CPU)')
+    args = parser.parse_args()
+
+    if args.unix:
+        server = UnixMiningServer(args.unix, args.workers)
+    else:
+        host, port = args.listen.rsplit(':', 1)
+        server = MiningServer((host, int(port)), args.workers)
+    print 'Serving on %s' % (server.server_address,)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,17 +1,28 @@
 #!/usr/bin/env python2
 import argparse
-from binascii import unhexlify
-from pyblake2 import blake2b
+from binascii import hexlify, unhexlify
+from itertools import imap, islice
 import struct
+import sys
 
-from convert import expand_array
+from convert import (
+    expand_array,
+    expand_arrays,
+    get_indices_from_minimal,
+    np,
+)
 from pow import (
+    equihash_params,
     hash_xi,
     print_hash,
+    start_pool,
+    verify_solutions,
     xor,
-    zcash_person,
 )
 
+# Number of headers each batch-mode worker task decodes and verifies
+BATCH_SIZE = 256
+
 
 class node(object):
     def __init__(self, h, children=[], xi=None):
@@ -31,27 +42,53 @@ class node(object):
             ret += child.__repr__(level+[False])
         return ret
 
-def get_indices_from_minimal(minimal, bit_len):
+def get_indices_from_minimals(minimals, bit_len):
+    '''Bulk variant of get_indices_from_minimal, for a list of minimal
+    encodings of the same length.'''
+    if np is None:
+        return [get_indices_from_minimal(bytearray(m), bit_len) for m in minimals]
     eh_index_size = 4
-    assert (bit_len+7)/8 <= eh_index_size
-    len_indices = 8*eh_index_size*len(minimal)/bit_len
+    minimal = np.frombuffer(b''.join(minimals), dtype=np.uint8).reshape(len(minimals), -1)
+    len_indices = 8*eh_index_size*minimal.shape[1]/bit_len
     byte_pad = eh_index_size - (bit_len+7)/8
-    expanded = expand_array(minimal, len_indices, bit_len, byte_pad)
-    return [struct.unpack('>I', expanded[i:i+4])[0] for i in range(0, len_indices, eh_index_size)]
+    expanded = expand_arrays(minimal, len_indices, bit_len, byte_pad)
+    return expanded.view('>u4').tolist()
+
+def solution_size(n, k):
+    '''Returns the size of the minimal encoding of a solution.'''
+    return (n/(k+1)+1)*2**k/8
+
+def header_size(n, k):
+    '''Returns the size of a block header, including its solution.'''
+    num_bytes = solution_size(n, k)
+    return 140 + (1 if num_bytes < 253 else 3) + num_bytes
+
+def parse_header(n, k, header):
+    '''Splits a block header into I, the nonce V and the minimal encoding of
+    the solution, which is prefixed with its compact size.'''
+    if len(header) < 143:
+        raise ValueError('Block header is truncated')
+    if ord(header[140]) < 253:
+        num_bytes, i = ord(header[140]), 141
+    else:
+        num_bytes, i = struct.unpack('<H', header[141:143])[0], 143
+    if num_bytes != solution_size(n, k):
+        raise ValueError('Block header does not match Equihash parameters')
+    if len(header) < i + num_bytes:
+        raise ValueError('Block header is truncated')
+    # V is a 256-bit little-endian integer
+    nonce = int(hexlify(header[108:140][::-1]), 16)
+    return header[:108], nonce, header[i:i+num_bytes]
 
 def generate_hashes(n, k, header):
-    collision_length = n/(k+1)
+    params = equihash_params(n, k)
+    collision_length = params.collision_length
     bit_len = collision_length + 1
-    hash_length = (k+1)*((collision_length+7)//8)
-    indices_per_hash_output = 512/n
-    num_indices = 2**k
+    hash_length = params.hash_length
+    indices_per_hash_output = params.indices_per_hash_output
 
-    digest = blake2b(digest_size=(512/n)*n/8, person=zcash_person(n, k))
-    digest.update(header[:140])
-    num_bytes = ord(header[140]) if ord(header[140]) < 253 else struct.unpack('<H', header[141:143])[0]
-    assert num_bytes == bit_len*num_indices/8, 'Block header does not match Equihash parameters'
-    i = 143 if ord(header[140]) == 253 else 141
-    soln = get_indices_from_minimal(bytearray(header[i:i+num_bytes]), bit_len)
+    digest = params.header_digest(header[:140])
+    soln = get_indices_from_minimal(bytearray(parse_header(n, k, header)[2]), bit_len)
 
     hashes = []
     for xi in soln:
@@ -73,6 +110,78 @@ def print_hashes(soln, hashes):
     print soln
     print nodes[0]
 
+def verify_headers(args):
+    '''Decodes and verifies a batch of block headers, in binary if raw is set
+    and otherwise in hexadecimal, returning None for each valid header and the
+    reason for rejecting each other one.'''
+    n, k, raw, headers = args
+    bit_len = n/(k+1) + 1
+    results = [None]*len(headers)
+    parsed = []
+    for j, header in enumerate(headers):
+        try:
+            if not raw:
+                header = unhexlify(header)
+            parsed.append((j,) + parse_header(n, k, header))
+        except TypeError:
+            results[j] = 'Block header is not hexadecimal'
+        except ValueError as e:
+            results[j] = str(e)
+    solns = get_indices_from_minimals([p[3] for p in parsed], bit_len) if parsed else []
+    valid = verify_solutions(n, k, [(I, nonce, soln)
+                                    for (_, I, nonce, _), soln in zip(parsed, solns)])
+    for (j, _, _, _), ok in zip(parsed, valid):
+        if not ok:
+            results[j] = 'Invalid solution'
+    return results
+
+def read_headers(f, n, k, raw=False):
+    '''Yields the block headers in f, either one in hexadecimal per line, or
+    concatenated in binary.'''
+    if raw:
+        size = header_size(n, k)
+        while True:
+            header = f.read(size)
+            if not header:
+                return
+            yield header
+    else:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+def batch_verify(n, k, f, out, raw=False, workers=None):
+    '''Verifies every block header in f, and writes one line per header to out
+    with its position in f and "ok" or "FAIL" and the reason.
+
+    Returns (number of headers, number of failures).'''
+    equihash_params(n, k)
+    headers = read_headers(f, n, k, raw)
+    batches = iter(lambda: (n, k, raw, list(islice(headers, BATCH_SIZE))), (n, k, raw, []))
+    if workers == 1:
+        pool = None
+        results = imap(verify_headers, batches)
+    else:
+        pool = start_pool(workers)
+        results = pool.imap(verify_headers, batches)
+    count = failures = 0
+    try:
+        for batch in results:
+            lines = []
+            for reason in batch:
+                if reason is None:
+                    lines.append('%d ok\n' % count)
+                else:
+                    lines.append('%d FAIL %s\n' % (count, reason))
+                    failures += 1
+                count += 1
+            out.write(''.join(lines))
+    finally:
+        if pool:
+            pool.terminate()
+    return count, failures
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Visualise an Equihash solution')
@@ -80,7 +189,30 @@ if __name__ == '__main__':
                         help='Equihash parameter N')
     parser.add_argument('k', type=int,
                         help='Equihash parameter K')
-    parser.add_argument('header', help='a block or block header in hexadecimal')
+    parser.add_argument('header', nargs='?',
+                        help='a block or block header in hexadecimal')
+    parser.add_argument('-b', '--batch', metavar='FILE',
+                        help='verify every header in FILE (- for stdin) instead, '
+                             'one in hexadecimal per line')
+    parser.add_argument('--raw', action='store_true',
+                        help='the batch file holds concatenated binary headers')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='number of processes to verify with (default: the tuned '
+                             'number, or one per CPU)')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='read the number of processes tuned by autotune.py from FILE')
     args = parser.parse_args()
 
+    if args.batch:
+        workers = args.workers
+        if workers is None:
+            from autotune import load_tuned
+            workers = (load_tuned(args.n, args.k, args.profile) or {}).get('verify_workers')
+        f = sys.stdin if args.batch == '-' else open(args.batch, 'rb')
+        count, failures = batch_verify(args.n, args.k, f, sys.stdout, args.raw, workers)
+        sys.stderr.write('%d headers, %d failed\n' % (count, failures))
+        sys.exit(1 if failures else 0)
+    if args.header is None:
+        parser.error('a header or --batch FILE is required')
+
     print_hashes(*generate_hashes(args.n, args.k, unhexlify(args.header)))
@@ -1,18 +1,78 @@
 #!/usr/bin/env python2
-from binascii import unhexlify
-from pyblake2 import blake2b
+import argparse
+from binascii import hexlify, unhexlify
+import imp
+import json
+import multiprocessing
+import os
+from Queue import Empty
+import shutil
+import socket
+from StringIO import StringIO
+import struct
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+from autotune import (
+    host_id,
+    load_tuned,
+    save_profile,
+)
+from bench import compare
+from cache import (
+    SolutionCache,
+    decode_entry,
+    encode_entry,
+)
+from checkpoint import Checkpoint
 from convert import (
     compress_array,
+    compress_arrays,
     expand_array,
+    expand_arrays,
+    get_minimal_from_indices,
+    np,
 )
 from pow import (
+    SLOW_SOLVERS,
+    block_hash,
+    count_zeroes,
+    difficulty_filter_batch,
+    equihash_params,
+    find_nonce,
+    find_nonce_parallel,
     gbp_basic,
-    hash_nonce,
-    hash_xi,
-    zcash_person,
+    gbp_bucketed,
+    gbp_packed,
+    generate_table,
+    get_solver,
+    mine,
+    mine_worker,
+    pack_nonce,
+    pipelined_tables,
+    start_process,
+    verify_solution,
+    verify_solutions,
+)
+from pow_service import (
+    MiningHandler,
+    UnixMiningServer,
 )
+try:
+    from pow_numpy import (
+        gbp_disk,
+        gbp_numpy,
+        gbp_sharded,
+        gbp_tree,
+    )
+except ImportError:
+    gbp_numpy = None
+
+PRINT_SOLN = imp.load_source(
+    'print_soln', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'print-soln.py'))
 
 EXPAND_COMPRESS_VECTORS = [
     ('8 11-bit chunks, all-ones', 11, 0,
@@ -128,8 +188,9 @@ ZCASH_TEST_VECTORS = [
 
 
 class ExpandAndCompressTestCase(unittest.TestCase):
-    def __init__(self, scope, bit_len, byte_pad, compact, expanded):
-        super(ExpandAndCompressTestCase, self).__init__('testExpandAndCompress')
+    def __init__(self, scope, bit_len, byte_pad, compact, expanded, bulk=False):
+        super(ExpandAndCompressTestCase, self).__init__(
+            'testBulkExpandAndCompress' if bulk else 'testExpandAndCompress')
         self.scope = scope
         self.bit_len = bit_len
         self.byte_pad = byte_pad
@@ -147,33 +208,757 @@ class ExpandAndCompressTestCase(unittest.TestCase):
                              self.bit_len, self.byte_pad)
         self.assertEqual(self.compact, out)
 
+    def testBulkExpandAndCompress(self):
+        rows = 3
+        compact = np.frombuffer(bytes(self.compact*rows), dtype=np.uint8).reshape(rows, -1)
+        expanded = np.frombuffer(bytes(self.expanded*rows), dtype=np.uint8).reshape(rows, -1)
+        out = expand_arrays(compact, len(self.expanded),
+                            self.bit_len, self.byte_pad)
+        self.assertEqual(self.expanded*rows, bytearray(out.tobytes()))
+        out = compress_arrays(expanded, len(self.compact),
+                              self.bit_len, self.byte_pad)
+        self.assertEqual(self.compact*rows, bytearray(out.tobytes()))
+
 class EquihashSolverTestCase(unittest.TestCase):
-    def __init__(self, n, k, I, nonce, solns):
-        super(EquihashSolverTestCase, self).__init__('testBasicSolver')
+    def __init__(self, n, k, I, nonce, solns, solver=gbp_basic, cache=None):
+        super(EquihashSolverTestCase, self).__init__('testSolver')
+        self.solver = solver
         self.n = n
         self.k = k
         self.I = I
         self.nonce = nonce
         self.solns = solns
+        self.cache = cache
 
     def shortDescription(self):
-        return '%d,%d: "%s" | %d' % (self.n, self.k, self.I, self.nonce)
+        return '%s %d,%d: "%s" | %d' % (self.solver.__name__, self.n, self.k, self.I, self.nonce)
 
-    def testBasicSolver(self):
-        digest = blake2b(digest_size=(512/self.n)*self.n/8, person=zcash_person(self.n, self.k))
-        digest.update(self.I)
-        hash_nonce(digest, self.nonce)
-        ret = gbp_basic(digest, self.n, self.k)
+    def testSolver(self):
+        digest = equihash_params(self.n, self.k).nonce_digest(self.I, self.nonce)
+        records = []
+        solver = self.cache.wrap(self.solver) if self.cache else self.solver
+        ret = list(solver(digest, self.n, self.k, hook=records.append))
         self.assertEqual(sorted(ret), self.solns)
+        if self.cache and not records:
+            # Served from the cache
+            return
+
+        # Each round's input is what the previous round kept
+        self.assertEqual([r['phase'] for r in records],
+                         ['list'] + ['round %d' % i for i in range(1, self.k)] + ['final'])
+        for prev, r in zip(records, records[1:]):
+            kept = prev['size'] if prev['phase'] == 'list' else prev['pairs'] - prev['dropped']
+            self.assertEqual(r['size'], kept)
+            self.assertEqual(sum(size*count for size, count in r['buckets'].items()),
+                             r['size'])
+        self.assertEqual(records[-1]['pairs'] - records[-1]['dropped'], len(ret))
+
+class EquihashPruningTestCase(unittest.TestCase):
+    def __init__(self, n, k, I, nonce, solns, solver=gbp_bucketed, max_pairs=12,
+                 keeps_all=False):
+        super(EquihashPruningTestCase, self).__init__('testPruning')
+        self.solver = solver
+        self.n = n
+        self.k = k
+        self.I = I
+        self.nonce = nonce
+        self.solns = solns
+        self.max_pairs = max_pairs
+        self.keeps_all = keeps_all
+
+    def shortDescription(self):
+        return '%s pruned to %d pairs %d,%d: "%s" | %d' % (
+            self.solver.__name__, self.max_pairs, self.n, self.k, self.I, self.nonce)
+
+    def testPruning(self):
+        digest = equihash_params(self.n, self.k).nonce_digest(self.I, self.nonce)
+        records = []
+        ret = self.solver(digest, self.n, self.k, hook=records.append,
+                          prune=True, max_pairs=self.max_pairs)
+        # Pruning only loses solutions
+        self.assertTrue(ret)
+        for soln in ret:
+            self.assertIn(soln, self.solns)
+        if self.keeps_all:
+            self.assertEqual(sorted(ret), self.solns)
+        self.assertTrue(any(r['capped'] for r in records[1:]))
+        self.assertTrue(any(r['zeros'] for r in records[1:]))
+        for prev, r in zip(records[1:], records[2:]):
+            self.assertEqual(r['size'], prev['pairs'] - prev['dropped'])
+        for r in records[1:]:
+            self.assertEqual(r['capped'], sum(count for size, count in r['buckets'].items()
+                                              if size*(size-1)/2 > self.max_pairs))
+
+class DiskSolverTestCase(unittest.TestCase):
+    def testPartitions(self):
+        # A 1 MiB budget splits every round of (96, 5) into partitions
+        n, k, I, nonce, solns = ZCASH_TEST_VECTORS[0]
+        digest = equihash_params(n, k).nonce_digest(I, nonce)
+        path = tempfile.mkdtemp()
+        try:
+            records = []
+            solver = get_solver('disk', ram_budget=1 << 20, tmp_dir=path)
+            self.assertEqual(sorted(solver(digest, n, k, hook=records.append)), solns)
+            self.assertTrue(all(r['partitions'] > 1 for r in records[1:]))
+            # The tables are kept under the given directory, and removed after
+            self.assertEqual(os.listdir(path), [])
+        finally:
+            shutil.rmtree(path)
+
+    def testNoCollisions(self):
+        # Round 1 pairs up entries 2m and 2m+1, and the rest of each pair is
+        # too sparse for the rounds after it to leave any entries
+        n, k = 48, 5
+        table = bytearray()
+        for j in range(equihash_params(n, k).list_length):
+            table += bytearray([j >> 1, (j & 1)*(j >> 1), 0, 0, 0, 0])
+        digest = equihash_params(n, k).header_digest(b'block header')
+        self.assertEqual(gbp_disk(digest, n, k, table=table), [])
+
+    def testOnlyDisk(self):
+        self.assertRaises(ValueError, get_solver, 'tree', ram_budget=1 << 20)
+        # The disk solver does not prune
+        self.assertRaises(ValueError, get_solver, 'disk', max_pairs=12, ram_budget=1 << 20)
+
+class EquihashVerifierTestCase(unittest.TestCase):
+    def __init__(self, n, k, I, nonce, solns):
+        super(EquihashVerifierTestCase, self).__init__('testVerifier')
+        self.n = n
+        self.k = k
+        self.I = I
+        self.nonce = nonce
+        self.solns = solns
+
+    def shortDescription(self):
+        return 'verify %d,%d: "%s" | %d' % (self.n, self.k, self.I, self.nonce)
+
+    def testVerifier(self):
+        for soln in self.solns:
+            self.assertTrue(verify_solution(self.n, self.k, self.I, self.nonce, soln))
+            # Wrong nonce
+            self.assertFalse(verify_solution(self.n, self.k, self.I, self.nonce+1, soln))
+            # Subtrees out of order
+            half = len(soln)/2
+            self.assertFalse(verify_solution(self.n, self.k, self.I, self.nonce,
+                                             soln[half:] + soln[:half]))
+            # Duplicate indices
+            self.assertFalse(verify_solution(self.n, self.k, self.I, self.nonce,
+                                             soln[:-1] + soln[-2:-1]))
+            # Wrong index
+            self.assertFalse(verify_solution(self.n, self.k, self.I, self.nonce,
+                                             soln[:-1] + [soln[-1]+1]))
+        self.assertEqual(
+            verify_solutions(self.n, self.k,
+                             [(self.I, self.nonce, soln) for soln in self.solns]),
+            [True]*len(self.solns))
+        # The difficulty of all the solutions is checked at once
+        zeroes = [count_zeroes(block_hash(self.I, self.nonce, soln)) for soln in self.solns]
+        d = max(zeroes) if zeroes else 0
+        self.assertEqual(difficulty_filter_batch(self.I, self.nonce, self.solns, d),
+                         [z == d for z in zeroes])
+
+class UnevenParamsVerifierTestCase(unittest.TestCase):
+    # n is not a multiple of k+1, so the trailing n % (k+1) bits of each hash
+    # are not part of any collision
+    n, k = 48, 4
+
+    def testSolverOutput(self):
+        solvers = [gbp_bucketed, gbp_packed] + ([gbp_tree] if gbp_numpy else [])
+        for nonce in range(3):
+            digest = equihash_params(self.n, self.k).nonce_digest(b'block header', nonce)
+            for solver in solvers:
+                solns = list(solver(digest, self.n, self.k))
+                self.assertTrue(solns)
+                self.assertEqual(
+                    verify_solutions(self.n, self.k,
+                                     [(b'block header', nonce, soln) for soln in solns]),
+                    [True]*len(solns))
+                for soln in solns:
+                    self.assertFalse(verify_solution(self.n, self.k, b'block header',
+                                                     nonce, soln[:-1] + [soln[-1]+1]))
+
+    def testWithoutNumPy(self):
+        # Without NumPy, each hash of the first list is expanded on its own
+        pow_module = sys.modules['pow']
+        digest = equihash_params(self.n, self.k).nonce_digest(b'block header', 0)
+        table = generate_table(digest, self.n, self.k)
+        np, pow_module.np = pow_module.np, None
+        try:
+            fallback = generate_table(digest, self.n, self.k)
+            solns = gbp_bucketed(digest, self.n, self.k)
+        finally:
+            pow_module.np = np
+        self.assertEqual(fallback, table)
+        self.assertTrue(solns)
+        self.assertEqual(verify_solutions(self.n, self.k,
+                                          [(b'block header', 0, soln) for soln in solns]),
+                         [True]*len(solns))
+
+class BatchVerifyTestCase(unittest.TestCase):
+    # Small enough to solve in a few milliseconds
+    n, k = 48, 5
+    I = b'batch header'.ljust(108, b'\0')
+
+    def setUp(self):
+        self.headers = []
+        for nonce in range(3):
+            digest = equihash_params(self.n, self.k).nonce_digest(self.I, nonce)
+            for soln in gbp_basic(digest, self.n, self.k):
+                self.headers.append(self.header(nonce, soln))
+        self.assertTrue(len(self.headers) > 1)
+
+    def header(self, nonce, soln):
+        minimal = bytes(get_minimal_from_indices(soln, self.n/(self.k+1) + 1))
+        return self.I + pack_nonce(nonce) + chr(len(minimal)) + minimal
+
+    def verify(self, data, raw=False, workers=1):
+        out = StringIO()
+        ret = PRINT_SOLN.batch_verify(self.n, self.k, StringIO(data), out, raw, workers)
+        return ret, out.getvalue().splitlines()
+
+    def testHex(self):
+        data = '\n\n'.join(hexlify(h) for h in self.headers) + '\n'
+        self.assertEqual(self.verify(data),
+                         ((len(self.headers), 0),
+                          ['%d ok' % i for i in range(len(self.headers))]))
+
+    def testRaw(self):
+        self.assertEqual(self.verify(b''.join(self.headers), raw=True),
+                         ((len(self.headers), 0),
+                          ['%d ok' % i for i in range(len(self.headers))]))
+
+    def testInvalid(self):
+        header = self.headers[0]
+        nonce = PRINT_SOLN.parse_header(self.n, self.k, header)[1]
+        wrong_nonce = header[:108] + pack_nonce(nonce+1) + header[140:]
+        lines = [hexlify(header[:-1]), 'zz', hexlify(wrong_nonce),
+                 hexlify(header[:140] + chr(1) + header[141:]), hexlify(header)]
+        self.assertEqual(self.verify('\n'.join(lines)), ((5, 4), [
+            '0 FAIL Block header is truncated',
+            '1 FAIL Block header is not hexadecimal',
+            '2 FAIL Invalid solution',
+            '3 FAIL Block header does not match Equihash parameters',
+            '4 ok',
+        ]))
+
+    def testWorkers(self):
+        # Results are written in order, across many small batches
+        bad = hexlify(self.headers[0][:-1])
+        lines = [hexlify(h) for h in self.headers]*5 + [bad]*3
+        lines = lines[::2] + lines[1::2]
+        batch_size = PRINT_SOLN.BATCH_SIZE
+        PRINT_SOLN.BATCH_SIZE = 2
+        try:
+            self.assertEqual(self.verify('\n'.join(lines), workers=3),
+                             self.verify('\n'.join(lines)))
+        finally:
+            PRINT_SOLN.BATCH_SIZE = batch_size
+
+class EquihashParamsTestCase(unittest.TestCase):
+    def testInvalidParams(self):
+        self.assertRaises(ValueError, equihash_params, 5, 5)
+        self.assertRaises(ValueError, equihash_params, 200, 5)
+
+    def testPackNonce(self):
+        for nonce in [0, 1, 2**32+5, 2**64+3, 2**256-1]:
+            self.assertEqual(pack_nonce(nonce), ''.join(
+                struct.pack('<I', (nonce >> (32*i)) & 0xffffffff) for i in range(8)))
+
+    def testCountZeroes(self):
+        self.assertEqual(count_zeroes(b'\x00\x0f\xff'), 12)
+        self.assertEqual(count_zeroes(bytearray(b'\x00\x00')), 16)
+        self.assertEqual(count_zeroes(b'\x80'), 0)
+
+    def testHeaderDigest(self):
+        params = equihash_params(96, 5)
+        a = params.nonce_digest('block header', 1).digest()
+        b = params.nonce_digest('other header', 1).digest()
+        self.assertNotEqual(a, b)
+        self.assertEqual(params.nonce_digest('block header', 1).digest(), a)
+        self.assertNotEqual(params.nonce_digest('block header', 2).digest(), a)
+
+class SolutionCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def solver(self, digest, n, k, hook=None):
+        # Returns the solutions of the first test vector, whatever the input
+        self.calls += 1
+        return ZCASH_TEST_VECTORS[0][4]
 
-def test_vectors():
+    def digest(self, nonce):
+        return equihash_params(96, 5).nonce_digest('block header', nonce)
+
+    def testEntries(self):
+        solns = ZCASH_TEST_VECTORS[0][4]
+        data = encode_entry(96, 5, solns)
+        # Header, minimal encodings and checksum
+        self.assertEqual(len(data), 16 + len(solns)*17*32/8 + 32)
+        self.assertEqual(decode_entry(96, 5, data), solns)
+        self.assertEqual(decode_entry(96, 5, encode_entry(96, 5, [])), [])
+        self.assertRaises(ValueError, decode_entry, 96, 5,
+                          data[:20] + chr(ord(data[20])^1) + data[21:])
+        self.assertRaises(ValueError, decode_entry, 96, 5, data[:-1])
+        self.assertRaises(ValueError, decode_entry, 200, 9, data)
+
+    def testWrap(self):
+        cache = SolutionCache(self.path)
+        solver = cache.wrap(self.solver, 'test')
+        for i in range(2):
+            self.assertEqual(list(solver(self.digest(0), 96, 5)), ZCASH_TEST_VECTORS[0][4])
+        self.assertEqual((self.calls, cache.hits, cache.misses), (1, 1, 1))
+        # Other nonces and solvers have their own entries
+        list(solver(self.digest(1), 96, 5))
+        list(cache.wrap(self.solver, 'other')(self.digest(0), 96, 5))
+        self.assertEqual(self.calls, 3)
+
+        # Corrupt entries are recomputed
+        path = cache.entry_path('test', 96, 5, self.digest(0))
+        with open(path, 'r+b') as f:
+            f.write('x')
+        self.assertEqual(list(solver(self.digest(0), 96, 5)), ZCASH_TEST_VECTORS[0][4])
+        self.assertEqual(self.calls, 4)
+
+    def testEviction(self):
+        entry_size = len(encode_entry(96, 5, ZCASH_TEST_VECTORS[0][4]))
+        cache = SolutionCache(self.path, max_size=2*entry_size)
+        solver = cache.wrap(self.solver, 'test')
+        for nonce in range(3):
+            list(solver(self.digest(nonce), 96, 5))
+            # Make the order of use visible to the next eviction
+            os.utime(cache.entry_path('test', 96, 5, self.digest(nonce)), (nonce, nonce))
+        list(solver(self.digest(1), 96, 5))
+        os.utime(cache.entry_path('test', 96, 5, self.digest(1)), (3, 3))
+        list(solver(self.digest(3), 96, 5))
+        self.assertEqual(sorted(os.listdir(self.path)), sorted(
+            os.path.basename(cache.entry_path('test', 96, 5, self.digest(nonce)))
+            for nonce in [1, 3]))
+
+class AutotuneTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'profile.json')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def testMissingProfile(self):
+        self.assertEqual(load_tuned(96, 5, self.path), None)
+        with open(self.path, 'w') as f:
+            f.write('{"truncated')
+        self.assertEqual(load_tuned(96, 5, self.path), None)
+
+    def testProfile(self):
+        config = {'solver': 'bucketed', 'workers': 2, 'pipeline': None}
+        other = dict(config, solver='packed')
+        save_profile({host_id(): {'96,5': config}, 'other host': {'200,9': other}},
+                     self.path)
+        self.assertEqual(load_tuned(96, 5, self.path), config)
+        # Only this host's configurations are used
+        self.assertEqual(load_tuned(200, 9, self.path), None)
+
+    def testDiskOptions(self):
+        # The memory budget is checked against the tuned solver
+        save_profile({host_id(): {'96,5': {'solver': 'bucketed', 'workers': 1,
+                                           'pipeline': None}}}, self.path)
+        self.assertRaises(ValueError, mine, 96, 5, 3, profile=self.path,
+                          ram_budget=1 << 20)
+
+class BenchCompareTestCase(unittest.TestCase):
+    def report(self, **results):
+        return {'results': dict((key, {'solves_per_sec': rate, 'correct': correct})
+                                for key, (rate, correct) in results.items())}
+
+    def testCompare(self):
+        baseline = self.report(slower=(10.0, True), same=(10.0, True),
+                               wrong=(10.0, True))
+        report = self.report(slower=(8.0, True), same=(9.5, True), wrong=(10.0, False),
+                             new=(1.0, True))
+        self.assertEqual(compare(report, baseline, 0.1), [
+            'slower: 8.000 solves/s, baseline 10.000 solves/s',
+            'wrong: incorrect solutions',
+        ])
+        self.assertEqual(compare(report, baseline, 0.25), ['wrong: incorrect solutions'])
+
+class MinerTestCase(unittest.TestCase):
+    def testStopsAtSolution(self):
+        # The solver is not resumed once a solution passes the filter
+        yielded = []
+        def solver(digest, n, k, hook=None):
+            for soln in [[1], [2]]:
+                yielded.append(soln)
+                yield soln
+        digest = equihash_params(96, 5).header_digest(b'block header')
+        self.assertEqual(find_nonce(digest, b'block header', 96, 5, 0, solver), (0, [1]))
+        self.assertEqual(yielded, [[1]])
+
+    def testParallelMatchesSerial(self):
+        # Solves take longer for some nonces than others, so the workers
+        # find solutions out of order
+        def solver(digest, n, k, hook=None):
+            time.sleep(ord(digest.digest()[0]) % 4 * 0.01)
+            if hook: hook({'phase': 'final'})
+            return [[j] for j in range(4)]
+        digest = equihash_params(96, 5).header_digest(b'block header')
+        serial = find_nonce(digest, b'block header', 96, 5, 8, solver)
+        self.assertNotEqual(serial, (None, None))
+        for workers in [2, 3]:
+            self.assertEqual(find_nonce_parallel(digest, b'block header', 96, 5, 8,
+                                                 solver, workers)[:2], serial)
+
+    def testStopInterruptsSolve(self):
+        # A stopped worker does not wait for its solve to finish
+        def solver(digest, n, k, hook=None):
+            time.sleep(60)
+            return []
+        digest = equihash_params(96, 5).header_digest(b'block header')
+        queue = multiprocessing.Queue()
+        stop = multiprocessing.Event()
+        p = multiprocessing.Process(target=mine_worker,
+                                    args=(queue, digest, b'block header', 96, 5, 0, solver,
+                                          0, 1, None, stop))
+        p.start()
+        time.sleep(0.5)
+        stop.set()
+        p.join(10)
+        self.assertFalse(p.is_alive())
+        self.assertEqual(p.exitcode, 0)
+        self.assertTrue(queue.empty())
+
+class PipelinedMinerTestCase(unittest.TestCase):
+    def testTables(self):
+        params = equihash_params(96, 5)
+        digest = params.header_digest(b'block header')
+        tables = pipelined_tables(digest, 96, 5, start=3, stride=2, depth=1)
+        for nonce in [3, 5]:
+            self.assertEqual(next(tables), (nonce, bytes(generate_table(
+                params.nonce_digest(b'block header', nonce), 96, 5))))
+        tables.close()
+
+    def testFindNonce(self):
+        # Each nonce is solved with its own first list
+        solved = []
+        def solver(digest, n, k, hook=None, table=None):
+            solved.append(table == bytes(generate_table(digest, n, k)))
+            return []
+        digest = equihash_params(96, 5).header_digest(b'block header')
+        tables = pipelined_tables(digest, 96, 5, start=1)
+        self.assertEqual(find_nonce(digest, b'block header', 96, 5, 0, solver, 1,
+                                    end=4, tables=tables), (None, None))
+        tables.close()
+        self.assertEqual(solved, [True]*3)
+
+class MiningServiceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'mine.sock')
+        self.server = UnixMiningServer(self.path, 1)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.connect(self.path)
+        self.reader = self.sock.makefile('r')
+
+    def tearDown(self):
+        self.reader.close()
+        self.sock.close()
+        self.server.shutdown()
+        self.server.server_close()
+        os.rmdir(os.path.dirname(self.path))
+
+    def request(self, **request):
+        self.sock.sendall(json.dumps(request) + '\n')
+
+    def reply(self):
+        return json.loads(self.reader.readline())
+
+    def testSubmit(self):
+        n, k, I, nonce, solns = ZCASH_TEST_VECTORS[0]
+        # Results still arrive after a running job has been terminated
+        self.request(id=0, method='submit', header=hexlify(I), n=n, k=k, d=200)
+        self.assertEqual(self.reply(), {'id': 0, 'job': 0, 'status': 'queued'})
+        time.sleep(0.5)
+        self.request(method='cancel', job=0)
+        self.assertEqual(self.reply(), {'job': 0, 'status': 'cancelled'})
+        self.assertEqual(self.reply(), {'cancelled': [0]})
+
+        solver = 'numpy' if gbp_numpy else 'bucketed'
+        self.request(id=1, method='submit', header=hexlify(I), n=n, k=k,
+                     start=nonce, end=nonce+1, solver=solver)
+        self.assertEqual(self.reply(), {'id': 1, 'job': 1, 'status': 'queued'})
+        r = self.reply()
+        self.assertEqual((r['job'], r['status'], r['nonce']), (1, 'found', nonce))
+        self.assertIn(r['solution'], solns)
+
+        self.request(id=2, method='submit', header='zz', n=n, k=k)
+        self.assertEqual(self.reply(), {'id': 2, 'error': 'header is not hexadecimal'})
+        # gbp_sharded cannot start its pool in a daemonic worker
+        self.request(id=3, method='submit', header=hexlify(I), n=n, k=k, solver='sharded')
+        self.assertEqual(self.reply(), {'id': 3, 'error':
+                                        'the sharded solver cannot run in a job\'s worker'})
+        self.request(id=4, method='submit', header=hexlify(I), n=n, k=-1)
+        self.assertEqual(self.reply(), {'id': 4, 'error': 'n and k must be positive'})
+
+    def testSendAfterClose(self):
+        # A job may report its result after its client has disconnected
+        a, b = socket.socketpair()
+        b.close()
+        handler = MiningHandler(a, None, self.server)
+        handler.send({'job': 0, 'status': 'exhausted'})
+        a.close()
+
+    def testCancel(self):
+        # Nothing passes a difficulty of 200
+        job = dict(method='submit', header=hexlify('block header'), n=96, k=5, d=200)
+        self.request(id=1, **job)
+        self.request(id=2, **job)
+        self.assertEqual(self.reply()['job'], 0)
+        self.assertEqual(self.reply()['job'], 1)
+        self.request(id=3, method='cancel', job=1)
+        self.assertEqual(self.reply(), {'job': 1, 'status': 'cancelled'})
+        self.assertEqual(self.reply(), {'id': 3, 'cancelled': [1]})
+        # New work replaces the running job
+        self.request(id=4, clean=True, **job)
+        self.assertEqual(self.reply(), {'job': 0, 'status': 'cancelled'})
+        self.assertEqual(self.reply(), {'id': 4, 'job': 2, 'status': 'queued'})
+
+class CheckpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'checkpoint')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testResumeSolve(self):
+        n, k, I, nonce, solns = ZCASH_TEST_VECTORS[0]
+        digest = equihash_params(n, k).nonce_digest(I, nonce)
+        class Preempted(Exception):
+            pass
+        def hook(record):
+            if record['phase'] == 'round 2':
+                raise Preempted()
+        self.assertRaises(Preempted, gbp_basic, digest, n, k, hook=hook,
+                          checkpoint=Checkpoint(self.path))
+
+        # Only the same solve resumes from the saved round
+        records = []
+        other = equihash_params(n, k).nonce_digest(I, nonce+1)
+        self.assertEqual(Checkpoint(self.path).load_table(other, n, k), None)
+        self.assertEqual(Checkpoint(self.path).load_table(digest, n, k, 6), None)
+        ret = gbp_bucketed(digest, n, k, hook=records.append,
+                           checkpoint=Checkpoint(self.path))
+        self.assertEqual(sorted(ret), solns)
+        self.assertEqual([r['phase'] for r in records],
+                         ['resume'] + ['round %d' % i for i in range(3, k)] + ['final'])
+        self.assertEqual(records[0]['round'], 2)
+
+    def testResumeMiner(self):
+        self.assertEqual(Checkpoint(self.path).resume(96, 5), None)
+        Checkpoint(self.path).start(96, 5, b'\x01'*32, 2**70 + 3)
+        self.assertEqual(Checkpoint(self.path).resume(96, 5), (b'\x01'*32, 2**70 + 3))
+        self.assertEqual(Checkpoint(self.path).resume(200, 9), None)
+        # Corrupt checkpoints are ignored
+        with open(self.path, 'r+b') as f:
+            f.write('x')
+        self.assertEqual(Checkpoint(self.path).resume(96, 5), None)
+
+class ParallelRunnerTestCase(unittest.TestCase):
+    def testMatchesSequential(self):
+        class Failing(unittest.TestCase):
+            def testFail(self):
+                self.fail('expected failure')
+            def testError(self):
+                raise ValueError('expected error')
+        tests = ([ExpandAndCompressTestCase(*tv) for tv in EXPAND_COMPRESS_VECTORS] +
+                 [Failing('testFail'), Failing('testError')])
+        outcomes = run_parallel(tests, 2, StringIO())
+        # The same tests run by unittest itself
+        result = unittest.TestResult()
+        unittest.TestSuite(tests).run(result)
+        failed = dict([(id(test), 'FAIL') for test, _ in result.failures] +
+                      [(id(test), 'ERROR') for test, _ in result.errors])
+        self.assertEqual([status for status, seconds, tb in outcomes],
+                         [failed.get(id(test), 'ok') for test in tests])
+        self.assertEqual([o[0] for o in outcomes[-2:]], ['FAIL', 'ERROR'])
+
+    def testTiers(self):
+        for n, k, I, nonce, solns in ZCASH_TEST_VECTORS:
+            for solver in [gbp_basic, gbp_bucketed, gbp_packed]:
+                self.assertEqual(test_tier(EquihashSolverTestCase(n, k, I, nonce, solns,
+                                                                  solver=solver)), 'slow')
+            if gbp_numpy:
+                slow = (n, k) in SLOW_PARAMS
+                self.assertEqual(test_tier(EquihashSolverTestCase(n, k, I, nonce, solns,
+                                                                  solver=gbp_numpy)),
+                                 'slow' if slow else 'fast')
+            self.assertEqual(test_tier(EquihashVerifierTestCase(n, k, I, nonce, solns)),
+                             'fast')
+
+# Parameter sets whose solver tests take minutes rather than seconds
+SLOW_PARAMS = [(200, 9), (144, 5)]
+
+def test_tier(test):
+    '''Returns 'slow' for the solver tests of the expensive parameter sets or
+    of the pure-Python solvers, and 'fast' for the others, including verifying
+    their solutions.'''
+    if isinstance(test, (EquihashSolverTestCase, EquihashPruningTestCase)):
+        if ((test.n, test.k) in SLOW_PARAMS or
+                test.solver.__name__[len('gbp_'):] in SLOW_SOLVERS):
+            return 'slow'
+    return 'fast'
+
+def flatten(suite):
+    for test in suite:
+        if isinstance(test, unittest.TestSuite):
+            for t in flatten(test):
+                yield t
+        else:
+            yield test
+
+def run_test(test):
+    '''Runs a single test, and returns its status, the time it took, and the
+    traceback of its failure if any.'''
+    result = unittest.TestResult()
+    start = time.time()
+    test.run(result)
+    seconds = time.time() - start
+    for status, errors in (('FAIL', result.failures), ('ERROR', result.errors)):
+        if errors:
+            return status, seconds, errors[0][1]
+    if result.skipped:
+        return 'skip', seconds, None
+    return 'ok', seconds, None
+
+def test_worker(w, tests, jobs, results):
+    for i in iter(jobs.get, None):
+        results.put((w, i, None, 0, None))
+        results.put((w, i) + run_test(tests[i]))
+
+def run_parallel(tests, workers, stream=sys.stderr):
+    '''Runs tests across worker processes, slow tier first, writing each
+    one's result and time to stream as it finishes.
+
+    Returns the (status, seconds, traceback) of each test, in order.'''
+    jobs = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    for i in sorted(range(len(tests)), key=lambda i: test_tier(tests[i]) != 'slow'):
+        jobs.put(i)
+    def start_worker(w):
+        jobs.put(None)
+        return start_process(test_worker, (w, tests, jobs, results), daemon=False)
+    stream.flush()
+    procs = [start_worker(w) for w in range(workers)]
+
+    # The test each worker is running
+    current = {}
+    outcomes = [None]*len(tests)
+    remaining = len(tests)
+    while remaining:
+        try:
+            w, i, status, seconds, tb = results.get(timeout=1)
+        except Empty:
+            # Replace workers that died in the middle of a test
+            for w, p in enumerate(procs):
+                if not p.is_alive() and w in current:
+                    i = current.pop(w)
+                    outcomes[i] = ('ERROR', 0, 'Worker exited with code %d\n' % p.exitcode)
+                    stream.write('%s ... ERROR\n' % test_name(tests[i]))
+                    remaining -= 1
+                    procs[w] = start_worker(w)
+            continue
+        if status is None:
+            current[w] = i
+            continue
+        del current[w]
+        outcomes[i] = (status, seconds, tb)
+        stream.write('%s ... %s (%.2fs)\n' % (test_name(tests[i]), status, seconds))
+        stream.flush()
+        remaining -= 1
+    for p in procs:
+        p.join()
+    return outcomes
+
+def test_name(test):
+    return test.shortDescription() or str(test)
+
+def test_vectors(cache=None):
+    '''Returns the test suite. If given, the solvers' results are cached in
+    the SolutionCache cache.'''
     suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(EquihashParamsTestCase))
+    suite.addTest(unittest.makeSuite(UnevenParamsVerifierTestCase))
+    suite.addTest(unittest.makeSuite(BatchVerifyTestCase))
+    suite.addTest(unittest.makeSuite(MiningServiceTestCase))
+    suite.addTest(unittest.makeSuite(SolutionCacheTestCase))
+    suite.addTest(unittest.makeSuite(CheckpointTestCase))
+    suite.addTest(unittest.makeSuite(MinerTestCase))
+    suite.addTest(unittest.makeSuite(PipelinedMinerTestCase))
+    suite.addTest(unittest.makeSuite(AutotuneTestCase))
+    suite.addTest(unittest.makeSuite(BenchCompareTestCase))
+    suite.addTest(unittest.makeSuite(ParallelRunnerTestCase))
     for tv in EXPAND_COMPRESS_VECTORS:
         suite.addTest(ExpandAndCompressTestCase(*tv))
+    if np is not None:
+        for tv in EXPAND_COMPRESS_VECTORS:
+            suite.addTest(ExpandAndCompressTestCase(*tv, bulk=True))
     for tv in ZCASH_TEST_VECTORS:
-        suite.addTest(EquihashSolverTestCase(*tv))
+        suite.addTest(EquihashVerifierTestCase(*tv))
+    for tv in ZCASH_TEST_VECTORS:
+        suite.addTest(EquihashSolverTestCase(*tv, cache=cache))
+    for tv in ZCASH_TEST_VECTORS:
+        suite.addTest(EquihashSolverTestCase(*tv, solver=gbp_bucketed, cache=cache))
+    for tv in ZCASH_TEST_VECTORS:
+        suite.addTest(EquihashSolverTestCase(*tv, solver=gbp_packed, cache=cache))
+    # Pruning is slow in pure Python, so only check it on the smallest vector
+    suite.addTest(EquihashPruningTestCase(*ZCASH_TEST_VECTORS[0]))
+    suite.addTest(EquihashPruningTestCase(*ZCASH_TEST_VECTORS[0], max_pairs=40,
+                                          keeps_all=True))
+    if gbp_numpy:
+        suite.addTest(unittest.makeSuite(DiskSolverTestCase))
+        for tv in ZCASH_TEST_VECTORS:
+            suite.addTest(EquihashSolverTestCase(*tv, solver=gbp_numpy, cache=cache))
+        for tv in ZCASH_TEST_VECTORS:
+            suite.addTest(EquihashSolverTestCase(*tv, solver=gbp_tree, cache=cache))
+        for tv in ZCASH_TEST_VECTORS:
+            suite.addTest(EquihashSolverTestCase(*tv, solver=gbp_sharded, cache=cache))
+        for tv in ZCASH_TEST_VECTORS:
+            suite.addTest(EquihashSolverTestCase(*tv, solver=gbp_disk, cache=cache))
     return suite
 
 
 if __name__ == '__main__':
-    unittest.TextTestRunner(verbosity=2).run(test_vectors())
+    parser = argparse.ArgumentParser(description='Run the Equihash tests')
+    parser.add_argument('-c', '--cache', metavar='DIR',
+                        help='cache the solvers\' results in DIR between runs')
+    parser.add_argument('-t', '--tier', choices=['fast', 'slow', 'all'], default='all',
+                        help='only run the fast or the slow tests (default: all)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='run the tests in this many processes, and report their times')
+    args = parser.parse_args()
+
+    cache = SolutionCache(args.cache) if args.cache else None
+    tests = [t for t in flatten(test_vectors(cache))
+             if args.tier in ('all', test_tier(t))]
+    if not args.jobs:
+        result = unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite(tests))
+        sys.exit(not result.wasSuccessful())
+
+    start = time.time()
+    outcomes = run_parallel(tests, args.jobs)
+    seconds = time.time() - start
+    failed = [(test, outcome) for test, outcome in zip(tests, outcomes)
+              if outcome[0] in ('FAIL', 'ERROR')]
+    for test, (status, _, tb) in failed:
+        sys.stderr.write('=' * 70 + '\n%s: %s\n' % (status, test_name(test)) +
+                         '-' * 70 + '\n' + tb + '\n')
+    sys.stderr.write('-' * 70 + '\nRan %d tests in %.3fs (%.3fs of test time)\n\n' % (
+        len(tests), seconds, sum(o[1] for o in outcomes)))
+    if failed:
+        sys.stderr.write('FAILED (failures=%d, errors=%d)\n' % (
+            sum(o[0] == 'FAIL' for _, o in failed), sum(o[0] == 'ERROR' for _, o in failed)))
+        sys.exit(1)
+    sys.stderr.write('OK\n')